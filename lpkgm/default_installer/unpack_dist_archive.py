@@ -19,7 +19,7 @@ def run(self, pkgName, pkgVer, prefix=None):
     #   tar xf ${pkg_dist} -C ${INSTALL_PATH} --strip-components=1
     cmd = ['tar', 'xvf', self._packageFiles['dist-archive'], '-C', prefix, '--strip-components=1']
 
-    outs, _, _ = execute_command(cmd)
+    outs, _, _ = execute_command(cmd, captureOutput=True)
     # collect files list (for uninstall)
     for l in outs.decode().splitlines():
         pp = pathlib.Path(*pathlib.Path(l).parts[1:])
@@ -1,11 +1,12 @@
-import os, logging, pickle, datetime, copy
+import os, sys, logging, json, gzip, datetime
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from fnmatch import fnmatch
 
 from lpkgm.utils import packages
 from lpkgm.settings import gSettings
-from lpkgm.utils import get_package_manifests
+from lpkgm.utils import get_package_manifests, load_json_file
+from lpkgm.protection import ProtectingRules
 
 # networkx warning workaround (need only for Python 3.9)
 import warnings
@@ -14,6 +15,14 @@ with warnings.catch_warnings():
     import networkx as nx
 #import networkx as nx
 
+def _pkg_node(pkgName, pkgVer):
+    """
+    Returns graph node key for package name and version. Strings are
+    interned, so equal names and versions of many nodes share same objects
+    (and compare by identity).
+    """
+    return (sys.intern(pkgName), sys.intern(pkgVer))
+
 class PkgGraph(object):
     """
     Wrapper on networkx graph representing package dependencies.
@@ -30,34 +39,40 @@ class PkgGraph(object):
         dg = nx.DiGraph()
         deps = []
         for pkgData, pkgFilePath in packages():
-            pkgName, pkgVer = pkgData['package'], pkgData['version']['fullVersion']
+            node = _pkg_node(pkgData['package'], pkgData['version']['fullVersion'])
             # add node to graph
-            dg.add_node((pkgName, pkgVer))
+            dg.add_node(node)
             for dep in pkgData['dependencies']:
-                deps.append(( (pkgName, pkgVer)
-                            , tuple(dep)
+                deps.append(( node
+                            , _pkg_node(*dep)
                             ))
         # connect dependencies
-        for depRel in deps:
-            dg.add_edge(*depRel)
+        dg.add_edges_from(deps)
         return dg
 
     def __init__(self, forceRebuild=False, filePath=None):
         """
-        Deserializes or builds global dependency graph.
+        Deserializes or builds global dependency graph. If ``filePath`` is
+        ``':memory:'``, graph is built from manifests and never cached in a
+        file.
         """
         L = logging.getLogger(__name__)
         if filePath:
             self._filePath = filePath
         else:
-            self._filePath = os.path.join(gSettings['packages-registry-dir'], 'deps.nx.gpickle')
-        if os.path.isfile(self._filePath) and not forceRebuild:
+            self._filePath = os.path.join(gSettings['packages-registry-dir'], 'deps.json.gz')
+        self._persist = ':memory:' != self._filePath
+        self.g = None
+        if self._persist and os.path.isfile(self._filePath) and not forceRebuild:
             # read cached
             L.debug(f'Using dependencies graph cache from {self._filePath}')
-            with open(self._filePath, 'rb') as f:
-                self.g = pickle.load(f)
-            self._dirty = False
-        else:
+            try:
+                self.g = self._load(self._filePath)
+                self._dirty = False
+            except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+                L.warning(f'Failed to read dependencies graph cache from {self._filePath}'
+                        f' ({e}); will re-generate it.')
+        if self.g is None:
             # otherwise -- rebuild and save cache
             L.debug("Re-generating dependencies graph.")
             self.g = self._build_dep_graph()
@@ -76,25 +91,69 @@ class PkgGraph(object):
         else:
             L.debug('Dep.graph did not change.')
 
+    @staticmethod
+    def _load(filePath):
+        """
+        Reads graph from (gzipped) JSON file written by ``save()``.
+        """
+        obj = load_json_file(filePath)
+        nodes = list(_pkg_node(*node) for node in obj['nodes'])
+        dg = nx.DiGraph()
+        dg.add_nodes_from(nodes)
+        dg.add_edges_from((nodes[i], nodes[j]) for i, j in obj['edges'])
+        return dg
+
     def save(self):
+        """
+        Writes graph as gzipped JSON: list of nodes (name and version pairs)
+        and list of edges given by pairs of indexes in the nodes list.
+        """
         L = logging.getLogger(__name__)
+        if not self._persist:
+            L.debug('In-memory dependencies graph is not cached.')
+            return
         L.debug(f'Dependencies graph cached at {self._filePath}')
-        with open(self._filePath, 'wb') as f:
-            pickle.dump(self.g, f, pickle.HIGHEST_PROTOCOL)
+        nodeIdx = dict((node, i) for i, node in enumerate(self.g.nodes))
+        obj = { 'nodes': list(nodeIdx.keys())
+              , 'edges': list((nodeIdx[a], nodeIdx[b]) for a, b in self.g.edges)
+              }
+        # cache is written to temporary file in the same dir and then renamed
+        # atomically, so concurrent readers (holding shared registry lock, or
+        # re-generating the cache by themselves) never see it half-written
+        tmpFilePath = f'{self._filePath}.{os.getpid()}.tmp'
+        try:
+            with gzip.open(tmpFilePath, 'wt', encoding='utf-8') as f:
+                json.dump(obj, f, separators=(',', ':'))
+            os.replace(tmpFilePath, self._filePath)
+        except BaseException:
+            if os.path.exists(tmpFilePath):
+                os.remove(tmpFilePath)
+            raise
 
     def dependency_of(self, pkgName, pkgVer):
         pv = pkgVer if type(pkgVer) is str else pkgVer['fullVersion']
-        return list(item[0] for item in self.g.in_edges((pkgName, pv)))
+        node = (pkgName, pv)
+        # (adjacency lookup, no edge tuples are built)
+        return list(self.g.predecessors(node)) if node in self.g else []
 
     def depends_on(self, pkgName, pkgVer):
         pv = pkgVer if type(pkgVer) is str else pkgVer['fullVersion']
-        return list(item[1] for item in self.g.out_edges((pkgName, pv)))
+        node = (pkgName, pv)
+        return list(self.g.successors(node)) if node in self.g else []
 
     def add(self, pkg1, pkg2):
         """
         Adds dependency meaning "pkg1 depends on (needs) pkg2"
         """
-        self.g.add_edge(tuple(pkg1), tuple(pkg2))
+        self.g.add_edge(_pkg_node(*pkg1), _pkg_node(*pkg2))
+        self._dirty = True
+
+    def add_many(self, pairs):
+        """
+        Adds multiple dependencies given by iterable of ``(pkg1, pkg2)``
+        pairs, each meaning "pkg1 depends on (needs) pkg2"
+        """
+        self.g.add_edges_from((_pkg_node(*pkg1), _pkg_node(*pkg2)) for pkg1, pkg2 in pairs)
         self._dirty = True
 
     def remove(self, pkg1, pkg2):
@@ -125,63 +184,78 @@ class PkgGraph(object):
         self._dirty = True
 
     def add_pkg(self, pkgName, pkgVer):
-        self.g.add_node((pkgName, pkgVer))
+        self.g.add_node(_pkg_node(pkgName, pkgVer))
         self._dirty = True
 
     def get_protecting_rules(self, pkgName, pkgVersion
             , protectionRules=None
             , recursive=True
+            , _cache=None
             ):
         """
-        Returns list of 3-element tuples:
-            (pkgName:str, pkgStrVer:str ruleLabel:str, [<dependencies>])
-        denoting reason of this package being protected from removal.
+        Returns ``ProtectingRules`` 4-element tuple:
+            (pkgName:str, pkgStrVer:str, ruleLabels:list, [<dependencies>])
+        denoting reason of this package being protected from removal, or
+        empty tuple if package is not protected.
         First returned package name is always eponymous to the argument
         (`pkgName`), others ...
         Used mainly to generate output usable for report printing.
+
+        Recursive results are memoized in ``_cache`` dict, if given (caller
+        may share it among calls with the same protection rules and
+        unchanged graph), so every package is evaluated once. Recursion over
+        packages depending on given one is done with explicit stack, so
+        depth of dependency chains is not limited by interpreter.
         """
         if type(pkgVersion) is dict:
             pkgVersion = pkgVersion['fullVersion']
-        L = logging.getLogger(__name__)
-        r = tuple()
-        # if no protection rule covers this package
-        protectedByRules = []
-        for rule in protectionRules.get(pkgName, []):
-            if rule(pkgVersion):
-                protectedByRules.append(rule.label)
-        if protectedByRules:
-            r = ( pkgName
-               , pkgVersion
-               , protectedByRules
-               , []
-               )
-        if not recursive: return r
-        # do the recursive check
-        # Get all the packages depending on given (packages this one provides),
-        # append the rules list, if need
-        rr = []
-        for dpName, dpVer in self.dependency_of(pkgName, pkgVersion):
-            # to get installed time of depending pkgs as we have to load
-            # full manifest :(
-            assert type(dpVer) is str  # only stringified versions must be stored in graph
-            dpRules = self.get_protecting_rules(dpName, dpVer
-                    , protectionRules=protectionRules
-                    , recursive=True
-                    )
-            if dpRules:
-                rr.append(dpRules)
-        if rr:
-            r = ( pkgName
-                , pkgVersion
-                , protectedByRules
-                , rr
-                )
-        return r
+        def _protected_by_rules(pkgName, pkgVersion):
+            return list(rule.label for rule in protectionRules.get(pkgName, [])
+                        if rule(pkgVersion))
+        if not recursive:
+            protectedByRules = _protected_by_rules(pkgName, pkgVersion)
+            # if no protection rule covers this package
+            if not protectedByRules: return tuple()
+            return ProtectingRules(pkgName, pkgVersion, protectedByRules, [])
+        if _cache is None: _cache = {}
+        root = (pkgName, pkgVersion)
+        r = _cache.get(root, None)
+        if r is not None: return r
+        # Depth-first traversal over packages depending on given (packages
+        # this one provides); stack items are (package, its dependees,
+        # iterator over not yet visited dependees). Result for package is
+        # built when results for all its dependees are known (post-order)
+        dependees = self.dependency_of(*root)
+        stack = [(root, dependees, iter(dependees))]
+        onStack = {root}
+        while stack:
+            node, dependees, dependeesIt = stack[-1]
+            for dp in dependeesIt:
+                # (dependee on stack means circular dependency -- it is
+                # accounted by its first occurrence)
+                if dp in _cache or dp in onStack: continue
+                assert type(dp[1]) is str  # only stringified versions must be stored in graph
+                dpDependees = self.dependency_of(*dp)
+                stack.append((dp, dpDependees, iter(dpDependees)))
+                onStack.add(dp)
+                break
+            else:
+                stack.pop()
+                onStack.discard(node)
+                protectedByRules = _protected_by_rules(*node)
+                # append the rules list of dependees, if need
+                rr = list(_cache[dp] for dp in dependees if _cache.get(dp))
+                _cache[node] = ProtectingRules(node[0], node[1], protectedByRules, rr) \
+                        if protectedByRules or rr else tuple()
+        return _cache[root]
 
     def isolated_subgraphs(self):
+        """
+        Yields read-only views (not copies) of isolated sub-graphs, lazily.
+        """
         #return nx.weakly_connected_component_subgraphs(self.g)  # no longer maintained starting from >~2.8
         for nodesSet in nx.weakly_connected_components(self.g):
-            yield self.g.subgraph(list(nodesSet))
+            yield self.g.subgraph(nodesSet)
 
     def unprotected_items(self):
         """
@@ -222,17 +296,19 @@ class PkgGraph(object):
         """
         Returns set of all (directly or indirectly) protected nodes
         """
-        
         # build set of is-protected pkgs (ones directly protected by at least one
         # of the rule)
-        protected1st = set(self.get_protected_rules_by_pkg(protectionRules).keys())
-        protectedAll = copy.copy(protected1st)
-        for protected1stPkg in protected1st:
-            # get all dependencies of "directly protected" package and add it to
-            # the protected ones (note, that `descendants returns ALL the
-            # descendants of arbitrary depth, not only the immediate ones)
-            for desc in nx.descendants(self.g, protected1stPkg):
-                protectedAll.add(desc)
+        protected1st = self.get_protected_rules_by_pkg(protectionRules).keys()
+        protectedAll = set(protected1st)
+        # add all dependencies (of arbitrary depth) of "directly protected"
+        # packages with single breadth-first traversal, so every node is
+        # visited once, even if shared by multiple protected packages
+        queue = deque(protectedAll)
+        while queue:
+            for dep in self.g.successors(queue.popleft()):
+                if dep in protectedAll: continue
+                protectedAll.add(dep)
+                queue.append(dep)
         return protectedAll
 
     def get_unprotected_pkgs(self, protectionRules):
@@ -268,27 +344,49 @@ class PkgGraph(object):
         Sorts given iterable `pkgs` for removal in a way that dependee always
         go before its dependency -- so that dependencies tree is kept
         consistent upon failures.
+
+        Returns list of tiers -- one per isolated sub-graph of given packages
+        (with no dependency relations between tiers, they can be removed
+        independently).
         """
         pkgs = set(pkgs_)
-        tiers = []
-        while pkgs:
-            tgt = None
-            for subGraphLarge in self.isolated_subgraphs():
-                subPkgs = set(subGraphLarge.nodes) & pkgs
-                if subPkgs:
-                    tgt = subPkgs
-                    break
-            if not tgt:
-                raise RuntimeError('No sub-graph found for any node of:'
-                        + ', '.join(f'{nm}/{ver}' for (nm, ver) in pkgs) )  # TODO: details
-            # got match with current subgraph and can remove some packages;
-            pkgs -= tgt  # pull the "removed" ones
-            # get sub-graph of to-remove nodes
-            subGraphToRemove = self.g.subgraph(list(tgt))
-            # put new tier as depth-first post-order
-            tiers.append(list(nx.dfs_postorder_nodes(subGraphToRemove)))
-        return tiers
+        missing = [pkg for pkg in pkgs if pkg not in self.g]
+        if missing:
+            raise RuntimeError('No sub-graph found for any node of:'
+                    + ', '.join(f'{nm}/{ver}' for (nm, ver) in missing) )  # TODO: details
+        if len(pkgs) < 2:
+            return [list(pkgs)] if pkgs else []
+        # only relations among given packages matter, so components are
+        # found within (view of) their sub-graph, not the whole registry
+        return list(self._removal_order(nodesSet)
+                for nodesSet in nx.weakly_connected_components(self.g.subgraph(pkgs)))
 
+    def _removal_order(self, pkgs):
+        """
+        Orders set of packages by Kahn's algorithm, with respect to dependency
+        relations among them only: package goes after all its dependees from
+        the set. Packages of the same "generation" are sorted to make order
+        deterministic.
+        """
+        # number of not yet ordered dependees of each package
+        nPending = dict((pkg, sum(1 for dep in self.g.successors(pkg) if dep in pkgs))
+                for pkg in pkgs)
+        frontier = sorted(pkg for pkg, n in nPending.items() if not n)
+        order = []
+        while frontier:
+            order += frontier
+            nextFrontier = []
+            for pkg in frontier:
+                for dpPkg in self.g.predecessors(pkg):
+                    if dpPkg not in nPending: continue
+                    nPending[dpPkg] -= 1
+                    if not nPending[dpPkg]:
+                        nextFrontier.append(dpPkg)
+            frontier = sorted(nextFrontier)
+        if len(order) != len(pkgs):
+            raise RuntimeError('Circular dependency among packages: '
+                    + ', '.join(f'{nm}/{ver}' for (nm, ver) in sorted(pkgs.difference(order))))
+        return order
 
 def show_tree(outStream, pkgName, pkgVerStr, depGraph):
     # TODO: if pkgName and/or pkgVer is given, retrieve subtree
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
-import os, sys, logging, json, copy, shutil, subprocess, re
-import traceback, pathlib
+import os, sys, logging, json, copy, shutil, subprocess, re, errno
+import traceback, pathlib, threading, contextlib, itertools
+from concurrent.futures import ThreadPoolExecutor
 from fnmatch import fnmatch
 from datetime import datetime
 import prettytable
@@ -11,7 +12,7 @@ import gitlab
 from lpkgm.settings import read_settings_file, gSettings
 from lpkgm.dependencies import PkgGraph, show_tree
 from lpkgm.utils import packages, pkg_manifest_file_path, stats_summary, \
-        get_package_manifests, sizeof_fmt
+        get_package_manifests, sizeof_fmt, registry_lock
 from lpkgm.installer import Installer
 from lpkgm.protection import protecting_rules_report, build_protection_rules, KeepVersion
 
@@ -21,6 +22,23 @@ from lpkgm.protection import protecting_rules_report, build_protection_rules, Ke
 # Entry point forwards execution to one of this functions (install, remove,
 # show).
 
+def parse_version(pkgVerStr, pkgSettings):
+    """
+    Parses version string with regular expressions given in package
+    settings. Returns version dictionary or ``None`` if string does not match
+    any of the expressions.
+    """
+    pkgVer = None
+    for rxs in pkgSettings['version-regex']:
+        m = re.match(rxs, pkgVerStr)
+        if not m: continue
+        if pkgVer is None:
+            # (copy, to not modify default values in settings)
+            pkgVer = copy.copy(pkgSettings.get('default-version-values', {}))
+        pkgVer.update(dict((k, v) for k, v in m.groupdict().items() if v is not None))
+        pkgVer['fullVersion'] = pkgVerStr
+    return pkgVer
+
 def install_package(pkgName, pkgVerStr, pkgSettings, use=None, modulescript=None, depGraph=None):
     L = logging.getLogger(__name__)
     if not use: use=[]
@@ -30,14 +48,7 @@ def install_package(pkgName, pkgVerStr, pkgSettings, use=None, modulescript=None
         raise RuntimeError(f"Package \"{pkgName}\" of version \"{pkgVerStr}\" installed"
                 f" (file {pkgInstallManifestFilePath} exists).")
     # try to parse version expression, if specified
-    pkgVer = None
-    for rxs in pkgSettings['version-regex']:
-        rx = re.compile(rxs)
-        m = rx.match(pkgVerStr)
-        if not m: continue
-        pkgVer = pkgSettings.get('default-version-values', {})
-        pkgVer.update(dict((k, v) for k, v in m.groupdict().items() if v is not None))
-        pkgVer['fullVersion'] = pkgVerStr
+    pkgVer = parse_version(pkgVerStr, pkgSettings)
     if not pkgVer:
         errStr =f'Failed to parse version expression "{pkgVerStr}"' \
                 + ' with any of version parsing expression(s) specified for' \
@@ -57,33 +68,32 @@ def install_package(pkgName, pkgVerStr, pkgSettings, use=None, modulescript=None
 
     # Resolve dependencies
     usedDeps = set()
-    if 'depends' in pkgSettings.keys() and pkgSettings['depends']:
+    # dependency name -> whether it is required
+    expectedDeps = dict((dep['name'], dep.get('required', True))
+            for dep in pkgSettings.get('depends', None) or [])
+    if expectedDeps:
         for providedDep in use:
-            if providedDep[0] not in set(d['name'] for d in pkgSettings['depends']):
-                L.warning('"use" argument'
-                        + f' {providedDep[0]}/{providedDep[1]} is not in demand'
-                        + f' of "{pkgName}".')
+            if providedDep[0] not in expectedDeps:
+                L.warning('"use" argument %s/%s is not in demand of "%s".'
+                        , providedDep[0], providedDep[1], pkgName)
                 continue
             installer.resolve_dependency(*providedDep)
             usedDeps.add(providedDep[0])
     # Check that use/depends are consistent
-    expectedDeps = set((dep['name'], dep.get('required', True)) for dep in pkgSettings.get('depends', []))
-    for expectedDep in expectedDeps:
-        if expectedDep[0] in usedDeps: continue
-        if expectedDep[1]:
-            raise RuntimeError(f'Missing required package {expectedDep[0]} (of {pkgName}).')
+    for depName, depRequired in expectedDeps.items():
+        if depName in usedDeps: continue
+        if depRequired:
+            raise RuntimeError(f'Missing required package {depName} (of {pkgName}).')
         else:
-            L.info('Missing optional package {expectedDep[0]} (of {pkgName})')
+            L.info('Missing optional package %s (of %s)', depName, pkgName)
 
     # Perform installation
     if not installer(pkgName, pkgVer):
-        L.critical(f'Failed to install {pkgName}-{pkgVerStr}.')
+        L.critical('Failed to install %s-%s.', pkgName, pkgVerStr)
         installer.on_exit(emergency=True)
         return False
     # update package file in registry
-    pkgDir = os.path.dirname(pkgInstallManifestFilePath)
-    if not os.path.isdir(pkgDir):
-        pathlib.Path(pkgDir).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(pkgInstallManifestFilePath).parent.mkdir(parents=True, exist_ok=True)
     stats = installer.stats
     pkgInfo = {
         "package": pkgName,
@@ -100,22 +110,25 @@ def install_package(pkgName, pkgVerStr, pkgSettings, use=None, modulescript=None
     # append dep graph if need
     if depGraph:
         if installer.dependenciesList:
-            for dep in installer.dependenciesList:
-                depGraph.add((pkgName, pkgVerStr), tuple(dep))
+            depGraph.add_many(((pkgName, pkgVerStr), dep)
+                    for dep in installer.dependenciesList)
         else:
             depGraph.add_pkg(pkgName, pkgVerStr)
     # run clean-up procedures
     installer.on_exit(emergency=False)
-    L.info(f'Package "{pkgName}" of version "{pkgVerStr}"'
-            + f' installed ({stats_summary(stats)})')
+    if L.isEnabledFor(logging.INFO):
+        L.info('Package "%s" of version "%s" installed (%s)'
+                , pkgName, pkgVerStr, stats_summary(stats))
     return True
 
-def _uninstall_package(pkgName, pkgData, depGraph=None):
+def _uninstall_package(pkgName, pkgData, pkgVerStr=None, depGraph=None, depGraphLock=None):
     L = logging.getLogger(__name__)
-    pkgVerStr = pkgData['version']['fullVersion']
-    L.info(f'Removing package "{pkgName}" of version "{pkgVerStr}"'
-            + f' ({stats_summary(pkgData["stats"])}), installed'
-            + f' at {pkgData["installedAt"]}')
+    if pkgVerStr is None:
+        pkgVerStr = pkgData['version']['fullVersion']
+    if L.isEnabledFor(logging.INFO):
+        L.info('Removing package "%s" of version "%s" (%s), installed at %s'
+                , pkgName, pkgVerStr, stats_summary(pkgData["stats"])
+                , pkgData["installedAt"])
     assert pkgData
     # recursively remove files and directories from install manifest
     try:
@@ -127,54 +140,61 @@ def _uninstall_package(pkgName, pkgData, depGraph=None):
                 dirs.add(fsEntry)
                 continue
             if os.path.islink(fsEntry):
-                L.debug(f'Un-linking {fsEntry}')
+                L.debug('Un-linking %s', fsEntry)
                 os.unlink(fsEntry)
                 continue
             if os.path.isfile(fsEntry):
-                L.debug(f'Deleting file {fsEntry}')
+                L.debug('Deleting file %s', fsEntry)
                 os.remove(fsEntry)
                 continue
-            L.warning(f'Unknown type of filesystem entry: {fsEntry}')
+            L.warning('Unknown type of filesystem entry: %s', fsEntry)
         while dirs:
             longestPath = list(sorted(dirs, key=lambda de: len(de)))[-1]
             if os.path.isdir(longestPath):
                 if not os.path.islink(longestPath):
-                    L.debug(f'Removing empty dirs starting from {longestPath}')
+                    L.debug('Removing empty dirs starting from %s', longestPath)
                     try:
                         os.removedirs(longestPath)
                     except OSError as e:
-                        if not str(e).startswith('[Errno 39] Directory not empty'):
-                            L.error(f'{str(e)}')
+                        # directory may be shared with other package(s),
+                        # including ones being removed concurrently (so it
+                        # may be removed already)
+                        if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                            L.error('%s', e)
                             raise
                 else:
-                    L.debug(f'Removing link {longestPath}')
+                    L.debug('Removing link %s', longestPath)
                     try:
                         os.unlink(longestPath)
                     except OSError as e:
-                        L.error(f'{str(e)}')
+                        L.error('%s', e)
                         raise
             dirs.remove(longestPath)
     except Exception as e:
         L.error('Error occured during removing FS entrie(s):')
         #traceback.print_exc()
         L.exception(e)
-        L.error(f'Package manifest file {pkg_manifest_file_path(pkgName, pkgVerStr)}'
-                + ' kept for further investigation. Log:')
+        L.error('Package manifest file %s kept for further investigation.'
+                , pkg_manifest_file_path(pkgName, pkgVerStr))
         return False
     # Delete manifest file
-    L.info(f'Deleting package manifest {pkg_manifest_file_path(pkgName, pkgVerStr)}')
-    os.remove(pkg_manifest_file_path(pkgName, pkgVerStr))
+    manifestFilePath = pkg_manifest_file_path(pkgName, pkgVerStr)
+    L.info('Deleting package manifest %s', manifestFilePath)
+    os.remove(manifestFilePath)
     if depGraph:
         try:
             # TODO: shaky... why?
             #for dep in pkgData['dependencies']:
             #    depGraph.remove((pkgName, pkgVerStr), dep)
-            depGraph.remove_pkg(pkgName, pkgVerStr)
+            # (networkx graph is not thread-safe, so modification is guarded
+            # when removal is done by multiple threads)
+            with (depGraphLock or contextlib.nullcontext()):
+                depGraph.remove_pkg(pkgName, pkgVerStr)
         except Exception as e:
             L.error('Failed to update dependency graph. Run lpkgm next time with --dep-recache'
                     ' to fix broken graph.')
             L.exception(e)
-    L.info(f'"{pkgName}" of version "{pkgVerStr}" removed.')
+    L.info('"%s" of version "%s" removed.', pkgName, pkgVerStr)
     return True
 
 def uninstall_packages( pkgNamePat, pkgVerStrPat, pkgs
@@ -206,8 +226,8 @@ def uninstall_packages( pkgNamePat, pkgVerStrPat, pkgs
         rmQueueNameAndVer = depGraph.get_matching_pkgs(pkgNamePat, pkgVerStrPat
                 , protectionRules=protectionRules)
         if not rmQueueNameAndVer:
-            L.warning(f'No package(s) matching {pkgNamePat}/{pkgVerStrPat} or'
-                    + ' matching are protected.')
+            L.warning('No package(s) matching %s/%s or matching are protected.'
+                    , pkgNamePat, pkgVerStrPat)
             return False
     # TODO: else EXACT name and version -- put directly to queue for inspection...
     # sort packages to be removed
@@ -216,16 +236,15 @@ def uninstall_packages( pkgNamePat, pkgVerStrPat, pkgs
     #for nTier, tier in enumerate(rmTiers):
     #    L.info('Cleaning up')
     #    pass
-    rmQueueSorted = []
-    for tier in rmTiers:
-        rmQueueSorted += tier
+    rmQueueSorted = list(itertools.chain.from_iterable(rmTiers))
     rmInfoMsg = f'Packages selected for deletion ({len(rmQueueSorted)}):'
     pTable = prettytable.PrettyTable()
     pTable.field_names = ['Package', 'Version', 'Stats']  # TODO: dependency of?
     pTable.align['Package'] = 'r'
     pTable.align['Version'] = 'l'
     blocks = []
-    rmQueue = []
+    rmQueue = {}  # (name, version) -> manifest
+    protectingRulesCache = {}  # shared by recursive protection checks
     for pkgName, pkgVerStr in rmQueueSorted:
         #rmInfoMsg += f'\n    {pkgName}/{pkgDatum["version"]["fullVersion"]}\t' \
         #          +'{stats_summary(pkgDatum["stats"])}\t{pkgDatum["installedAt"]}'
@@ -236,7 +255,7 @@ def uninstall_packages( pkgNamePat, pkgVerStrPat, pkgs
         elif len(pkgDatum) > 1:
             raise RuntimeError(f'Multiple package manifests are found for {pkgName}/{pkgVerStr}')
         pkgDatum = pkgDatum[0]
-        rmQueue.append((pkgName, pkgDatum))
+        rmQueue[(pkgName, pkgVerStr)] = pkgDatum
         pTable.add_row([pkgName, pkgVerStr, stats_summary(pkgDatum["stats"])])
         # check we really can delete the package not breaking any dependant packages
         #provides = depGraph.dependency_of(pkgName, pkgVerStr)
@@ -244,48 +263,68 @@ def uninstall_packages( pkgNamePat, pkgVerStrPat, pkgs
         #    providesStr = ', '.join(f'{depName}/{depVer}' for depName, depVer in provides)
         #    blocks.append(f'    {pkgName}/{pkgVerStr} is needed by {providesStr}')
         # ---
-        # get protection rules; note, that even for unprotected packages,
-        # deletion will be prohibited by non-trivial result (at least one
-        # tuple of the form [(name, version, None, [...])] will be returned
+        # get protection rules; empty tuple is returned for package that is
+        # neither protected by a rule itself, nor provides a protected
+        # package (directly or not)
         protectedBy = depGraph.get_protecting_rules( pkgName, pkgVerStr
                 , protectionRules=protectionRules
                 , recursive=True
+                , _cache=protectingRulesCache
                 )
-        if protectedBy and (protectedBy[0][2] or protectedBy[0][3]):
-            # ^^^ 0 - name, 1 - ver, 2 - rule label, 3 - provided pkgs
-            #     so "protectedBy[3] or protectedBy[4]" is equivalent
-            #     to "protected by rule or provides pkg(s)"
-            blocks.append(protecting_rules_report(protectedBy))
+        if protectedBy and (protectedBy.rules or protectedBy.dependees):
+            # ^^^ "protected by rule(s) or provides protected pkg(s)"
+            blocks.append(protecting_rules_report([protectedBy]))
     rmInfoMsg += '\n' + str(pTable)
     L.info(rmInfoMsg)
     if blocks:
         L.critical('Following issues found for deletion request:\n' + '\n'.join(blocks))
         raise RuntimeError('Other installed package depends on package(s) queued for removal.')
+    if not autoConfirm and not sys.stdin.isatty():
+        # no autoconfirm option given, not a prompt -- apparently, a batch
+        # run, we abort deletion as a precaution
+        L.warning('Automatic confirmation is not set, terminal is not a TTY,'
+                ' refusing delete %d package(s).', len(rmQueue))
+        return False
     if not autoConfirm:
-        if sys.stdin.isatty():
-            answer = ''
-            while answer.lower() not in ('yes', 'no'):
-                answer = input('\033[1mConfirm deletion of selected packages?\033[0m (please, type "yes" or "no"): ')
-                if 'no' == answer.lower():
-                    return False
-                elif 'yes' == answer.lower():
-                    break
-        else:
-            # no autoconfirm option given, not a prompt -- apparently, a batch
-            # run, we abort deletion as a precaution
-            L.warning('Automatic confirmation is not set, terminal is not a TTY,'
-                    + f' refusing delete {len(rmQueue)} package(s).')
+        # anything but explicit "yes" cancels deletion
+        answer = input('\033[1mConfirm deletion of selected packages?\033[0m'
+                ' (please, type "yes" to proceed): ').strip().lower()
+        if 'yes' != answer:
+            L.info('Deletion cancelled.')
             return False
     L.info('Deleting package(s)...') 
-    for pkgName, pkgDatum in rmQueue:
-        pkgVerStr = pkgDatum['version']['fullVersion']
-        _uninstall_package(pkgName, pkgDatum, depGraph=depGraph)
-    return True
+    # Tiers are isolated sub-graphs of removed packages, so they are removed
+    # in parallel, while within a tier packages are removed strictly in order
+    # (dependee before its dependency). Failure within a tier stops its
+    # removal to keep dependencies of not-removed package.
+    depGraphLock = threading.Lock()
+    def _uninstall_tier(tier):
+        for pkgName, pkgVerStr in tier:
+            if not _uninstall_package(pkgName, rmQueue[(pkgName, pkgVerStr)]
+                    , pkgVerStr=pkgVerStr
+                    , depGraph=depGraph, depGraphLock=depGraphLock):
+                L.error('Removal of %d package(s) sharing dependencies with'
+                        ' %s/%s interrupted.', len(tier), pkgName, pkgVerStr)
+                return False
+        return True
+    with ThreadPoolExecutor() as executor:
+        results = list(executor.map(_uninstall_tier, rmTiers))
+    return all(results)
+
+def _paint(row, clr, useColor):
+    """Wraps package name and version columns of the row with color codes."""
+    if not useColor: return
+    row[0] = f'{clr}{row[0]}\033[0m'
+    row[1] = f'{clr}{row[1]}\033[0m'
 
 def show( outStream, pkgName, pkgVer, format_='ascii', depGraph=None
         , protectionRules=None):
     L = logging.getLogger(__name__)
     if not protectionRules: protectionRules = {}
+    # ANSI color codes are only meaningful for the terminal (they would
+    # corrupt JSON/HTML or redirected output)
+    useColor = 'ascii' == format_ \
+            and hasattr(outStream, 'isatty') and outStream.isatty()
     pTable = None
     if not pkgVer:
         # in this mode we list all installed packages in a table:
@@ -294,6 +333,7 @@ def show( outStream, pkgName, pkgVer, format_='ascii', depGraph=None
         # content has at least "package" and "version" attributes
         overallSize = 0
         pTable = None
+        protectingRulesCache = {}  # shared by recursive protection checks
         #for pkgFilePath in glob.glob(gSettings['packages-registry-dir'] + '/*/*.json'):
         #    with open(pkgFilePath, 'r') as pkgFile:
         #        pkgData = json.load(pkgFile)
@@ -329,6 +369,7 @@ def show( outStream, pkgName, pkgVer, format_='ascii', depGraph=None
                 protectedDetails = depGraph.get_protecting_rules(pkgData['package'], pkgData['version']
                         , protectionRules=protectionRules
                         , recursive=True
+                        , _cache=protectingRulesCache
                         )
                 # protected by rule(s), not required by anything -- bold green
                 # protected by rule(s), required by something -- green
@@ -336,23 +377,23 @@ def show( outStream, pkgName, pkgVer, format_='ascii', depGraph=None
                 # orphaned -- red
                 if not protectedDetails:  # not protected with faided color
                     clr = '\033[31m'  # orphaned (unprotected, removed after next gc) -- with red
-                    row[0] = f'{clr}{row[0]}\033[0m'
-                    row[1] = f'{clr}{row[1]}\033[0m'
-                    row.append(f'{clr}orphane\033[0m')
-                elif protectedDetails[2]:  # has own protection rule
-                    if protectedDetails[3]:  # additionally, is required somewhere
+                    _paint(row, clr, useColor)
+                    row.append(f'{clr}orphane\033[0m' if useColor else 'orphane')
+                elif protectedDetails.rules:  # has own protection rule
+                    if protectedDetails.dependees:  # additionally, is required somewhere
                         clr = '\033[32;1m'
                     else:
                         clr = '\033[32m'
-                    row[0] = f'{clr}{row[0]}\033[0m'
-                    row[1] = f'{clr}{row[1]}\033[0m'
-                    row.append('\n'.join(f'{clr}{ruleStr}\033[0m' for ruleStr in protectedDetails[2]))
+                    _paint(row, clr, useColor)
+                    if useColor:
+                        row.append('\n'.join(f'{clr}{ruleStr}\033[0m' for ruleStr in protectedDetails.rules))
+                    else:
+                        row.append('\n'.join(protectedDetails.rules))
                 else:
                     # otherwise, required by smt, -- of faded color
                     clr = '\033[2m'
-                    row[0] = f'{clr}{row[0]}\033[0m'
-                    row[1] = f'{clr}{row[1]}\033[0m'
-                    row.append(f'{clr}required\033[0m')
+                    _paint(row, clr, useColor)
+                    row.append(f'{clr}required\033[0m' if useColor else 'required')
             pTable.add_row(row)
             overallSize += pkgData['stats']['size']
         if not pTable:
@@ -477,15 +518,18 @@ def lpkgm_run_from_cmd_args(argv):
         return False
     # run specific procedure
     try:
-        with PkgGraph( forceRebuild=args.dep_recache
-                , filePath=os.path.join(gSettings['packages-registry-dir'], 'deps.nx.gpickle')) as depGraph:
+        # shared lock for read-only operations, exclusive for ones modifying
+        # the registry
+        with registry_lock(exclusive=args.dep_recache or args.mode not in gShowCmdAliases), \
+             PkgGraph( forceRebuild=args.dep_recache
+                , filePath=os.path.join(gSettings['packages-registry-dir'], 'deps.json.gz')) as depGraph:
             if args.mode in gInstallCmdAliases:  # INSTALL
                 if not pkgSettings:
-                    L.critical('No package matching "{args.pkgName}".')
+                    L.critical('No package matching "%s".', args.pkgName)
                     return False
                 if len(pkgSettings) > 1:
-                    L.critical('Multiple packages match "{args.pkgName}": '
-                            + ', '.join(p[0] for p in pkgSettings))
+                    L.critical('Multiple packages match "%s": %s', args.pkgName
+                            , ', '.join(p[0] for p in pkgSettings))
                     return False
                 return install_package(args.pkgName, args.pkgVersion, pkgSettings[0][1]
                         , use=args.use
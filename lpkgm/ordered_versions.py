@@ -1,30 +1,50 @@
-import copy
-from collections import defaultdict
+import functools, itertools, heapq, operator
 
 def convert_version_subnum(n):
     if n is None: return 0
     return int(n)
 
+def convert_literal(x):
+    return x
+
 # ... other version subnum converters?
 
+@functools.lru_cache(maxsize=None)
 def converter_from_str(name):
     if 'convert_version_subnum' == name:
         return convert_version_subnum
     if 'literal' == name or 'identical' == name or 'identic' == name:
-        return lambda x: x
+        return convert_literal
     raise RuntimeError('Can not interpret conversion function'
             + f' name "{name}" in the version attribute reference')
 
+# Resolved (name, converter) pairs, indexed by (attrItem, default_cnv)
+_gAttrGettersCache = {}
+
 def attr_item_to_getter(attrItem, default_cnv=convert_version_subnum):
-    if type(attrItem) is str:
+    if isinstance(attrItem, list):
+        attrItem = tuple(attrItem)
+    k = (attrItem, default_cnv)
+    try:
+        return _gAttrGettersCache[k]
+    except TypeError:
+        # unhashable item, do not cache
+        return _attr_item_to_getter(attrItem, default_cnv)
+    except KeyError:
+        pass
+    r = _gAttrGettersCache[k] = _attr_item_to_getter(attrItem, default_cnv)
+    return r
+
+def _attr_item_to_getter(attrItem, default_cnv):
+    if isinstance(attrItem, str):
         return (attrItem, default_cnv)
-    if type(attrItem) in (tuple, list) \
+    if isinstance(attrItem, tuple) \
     and 2 == len(attrItem) \
-    and type(attrItem[0]) is str:
-        if type(attrItem[1]) is str:
+    and isinstance(attrItem[0], str):
+        if isinstance(attrItem[1], str):
             return attrItem[0], converter_from_str(attrItem[1])
         elif callable(attrItem[1]):
-            return tuple(attrItem)
+            return attrItem
     raise RuntimeError('Can not interpret reference to version attribute.')
 
 
@@ -52,7 +72,42 @@ class VersionsOrder(object):
         self._attrOrder = list(attr_item_to_getter(attr) for attr in attributesOrder)
         if ortogonalBy is None:
             ortogonalBy = type(self).defaultOrtogonalAttrs
-        self._ortogonalBy = list(attr_item_to_getter(attr, default_cnv=lambda x: x) for attr in ortogonalBy)
+        self._ortogonalBy = list(attr_item_to_getter(attr, default_cnv=convert_literal) for attr in ortogonalBy)
+        self._extract = self._compile_extractor()
+
+    def _compile_extractor(self):
+        """
+        Returns function building canonic version tuple from version dict and
+        installation time.
+
+        Since attributes and converters are fixed for the instance, function
+        is generated as a straight-line code with no iteration (it is called
+        for every installed version of a package).
+        """
+        ns, lines = {}, []
+        nItem = itertools.count()
+        def _item_expr(k, cnv, default='None'):
+            getExpr = f'd.get({k!r}, {default})'
+            if cnv is convert_literal: return getExpr
+            n = next(nItem)
+            if cnv is convert_version_subnum:
+                # inlined to avoid function call; values are most often
+                # already integers
+                lines.append(f'    _v{n} = {getExpr}\n')
+                return f'(0 if _v{n} is None else (_v{n} if _v{n}.__class__ is int else int(_v{n})))'
+            ns[f'_cnv{n}'] = cnv
+            return f'_cnv{n}({getExpr})'
+        ortoItems = list(_item_expr(k, cnv) for k, cnv in self._ortogonalBy)
+        # `_installTime' is taken from the argument if (most probably) package
+        # version was not artificially annotated with it
+        verItems = list(_item_expr(k, cnv
+                        , default=('installTime' if '_installTime' == k else 'None'))
+                    for k, cnv in self._attrOrder)
+        src = 'def _extract(d, installTime):\n' + ''.join(lines) \
+            + '    return (' + ''.join(f'{item}, ' for item in ortoItems) + '), (' \
+                           + ''.join(f'{item}, ' for item in verItems) + ')\n'
+        exec(compile(src, f'<{type(self).__name__}>', 'exec'), ns)
+        return ns['_extract']
 
     def canonic_version_tuple(self, pkgVer_, installTime=None):
         """
@@ -60,36 +115,72 @@ class VersionsOrder(object):
         Returns (<flavour:tuple>, <version:tuple>)
         """
         assert type(pkgVer_) is dict
-        # append with `_installTime' if (most probably) package version
-        # was not artificially annotated with it
-        pkgVer = copy.copy(pkgVer_)
-        if '_installTime' not in pkgVer.keys(): pkgVer['_installTime'] = installTime
-        ortoKeys = tuple(cnv(pkgVer_.get(k, None)) for k, cnv in self._ortogonalBy) if self.flavourKeys else None
-        version  = tuple(cnv(pkgVer.get(k, None)) for k, cnv in self._attrOrder)
-        # build key to sort by
-        return ortoKeys, version 
-
-    @property
+        return self._extract(pkgVer_, installTime)
+
+    @functools.cached_property
     def flavourKeys(self):
         return list(c for c, _ in self._ortogonalBy) if self._ortogonalBy else [None,]
 
-    @property
+    @functools.cached_property
     def attrKeys(self):
         return list(c for c, _ in self._attrOrder) if self._attrOrder else [None,]
 
-    def __call__(self, pkgVersions):
-        # build list of items: {(attrs...): pkgVerDict}
-        versionsByOrtogonalAttr = defaultdict(dict)
-        for pkgVer_ in pkgVersions:
-            ortoKeys, verKey = self.canonic_version_tuple(pkgVer_)
-            versionsByOrtogonalAttr[ortoKeys][verKey] = pkgVer_
+    def __call__(self, pkgVersionsAndDate, topK=None):
+        """
+        Groups ``(pkgVer, installTime)`` pairs by flavour and yields
+        ``(flavour, sortedVersions)`` pairs, where ``sortedVersions`` is list
+        of ``(canonicVersionTuple, (pkgVer, installTime))`` in ascending
+        order. If ``topK`` is given, only ``topK`` most recent versions are
+        retained per flavour.
+        """
+        return self.sort_keyed(((*self.canonic_version_tuple(pkgVer_, installTime), (pkgVer_, installTime))
+                    for pkgVer_, installTime in pkgVersionsAndDate), topK=topK)
+
+    @staticmethod
+    def sort_keyed(keyedVersions, topK=None):
+        """
+        Same as calling the instance, but for iterable of
+        ``(flavour, canonicVersionTuple, payload)`` triples with canonic
+        tuples computed beforehand (see ``canonic_version_tuple()``).
+        """
+        # build lists of items: {(attrs...): [(verKey, payload), ...]}
+        versionsByOrtogonalAttr = {}
+        for ortoKeys, verKey, payload in keyedVersions:
+            versionsByOrtogonalAttr.setdefault(ortoKeys, []).append((verKey, payload))
         # Use tuple comparison to sort resulting "keys",
         # see "Lexicographical comparison" in
         #       https://docs.python.org/3/reference/expressions.html#value-comparisons
-        # (TODO: test?)
-        # leave only N most recent ones
-        #self._protectedVersions = list(sorted(versions.keys()))[-self._limit:]
-        result = {}
-        for orthoKey, versions in versionsByOrtogonalAttr.items():
-            yield orthoKey, list((k, versions[k]) for k in sorted(versions.keys()))
+        # (payloads are never compared); leave only N most recent versions if
+        # limit is given -- items with equal canonic tuples are the same
+        # version, so limit is applied to distinct tuples and all the items
+        # sharing them are kept
+        byKey = operator.itemgetter(0)
+        for orthoKey, items in versionsByOrtogonalAttr.items():
+            if topK is not None:
+                lowestKey = heapq.nlargest(topK, set(map(byKey, items)))[-1]
+                items = [item for item in items if item[0] >= lowestKey]
+            items.sort(key=byKey)
+            yield orthoKey, items
+
+# Shared VersionsOrder instances, indexed by their (hashable) configuration
+_gVersionsOrders = {}
 
+def get_versions_order(attributesOrder=None, ortogonalBy=None):
+    """
+    Returns ``VersionsOrder`` instance for given configuration, re-using
+    previously created one if configuration is the same. Shared instances
+    let callers share cached canonic tuples computed by the same order.
+    """
+    def _hashable(attrs):
+        if attrs is None: return None
+        return tuple(tuple(attr) if isinstance(attr, list) else attr for attr in attrs)
+    k = (_hashable(attributesOrder), _hashable(ortogonalBy))
+    try:
+        order = _gVersionsOrders.get(k, None)
+    except TypeError:
+        # unhashable item in configuration
+        return VersionsOrder(attributesOrder=attributesOrder, ortogonalBy=ortogonalBy)
+    if order is None:
+        order = _gVersionsOrders[k] = VersionsOrder(attributesOrder=attributesOrder
+                , ortogonalBy=ortogonalBy)
+    return order
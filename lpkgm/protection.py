@@ -1,8 +1,6 @@
-import io, datetime, logging, copy
-
-from collections import defaultdict
-from fnmatch import fnmatch
+import logging, re, fnmatch
 
+from collections import defaultdict, namedtuple
 import lpkgm.ordered_versions
 
 class ProtectionRule(object):
@@ -14,6 +12,8 @@ class ProtectionRule(object):
 
     This is an abstract base class for protection rules.
     """
+    __slots__ = ('_label',)
+
     def __init__(self, label='abstract', **kwargs):
         self._label = label
 
@@ -30,6 +30,8 @@ class KeepAll(ProtectionRule):
     """
     Protection rule that keeps all the packages provided.
     """
+    __slots__ = ()
+
     def __init__(self, label, **kwargs):
         super().__init__(label)
 
@@ -42,12 +44,16 @@ class KeepVersion(ProtectionRule):
     """
     Protects wildcard-matching versions.    
     """
+    __slots__ = ('_versionPattern', '_match')
+
     def __init__(self, label, versionPattern, **kwargs):
         super().__init__(label)
         self._versionPattern = versionPattern
+        # wildcard is translated into regular expression once
+        self._match = re.compile(fnmatch.translate(versionPattern)).match
 
     def __call__(self, pkgVersion):
-        return fnmatch(pkgVersion, self._versionPattern)
+        return self._match(pkgVersion) is not None
 
 #                       * * *   * * *   * * *
 
@@ -55,6 +61,8 @@ class KeepNone(ProtectionRule):
     """
     Abstract protection rule that does not keep all the packages provided.
     """
+    __slots__ = ()
+
     def __init__(self, label, **kwargs):
         super().__init__(label)
 
@@ -63,6 +71,10 @@ class KeepNone(ProtectionRule):
 
 #                       * * *   * * *   * * *
 
+# Canonic version tuples indexed by (order, package name, version string,
+# install time), shared among "latest" rules
+gCanonicKeys = {}
+
 class KeepLatestProtectionRule(ProtectionRule):
     """
     Protects latest N versions of the package, with respect to versions
@@ -72,14 +84,22 @@ class KeepLatestProtectionRule(ProtectionRule):
     This rule needs to know all the installed package version first, so
     its constructor needs to load package's manifests first.
     """
+    __slots__ = ( '_pkgName', '_versionsCache', '_limit', '_order'
+                , '_canonicKeys', '_sorted', '_topSets' )
+
     def __init__( self
                 , pkgName
                 , label='latest'
                 , attrsOrder=None
                 , flavourFrom=None
                 , latestLimit=1
+                , preloaded=None
                 , **kwargs
                 ):
+        """
+        If ``preloaded`` list of ``(pkgData, manifestPath)`` pairs is given,
+        it is used instead of loading package's manifests.
+        """
         from lpkgm.utils import packages  # import here to avoid circular import
         L = logging.getLogger(__name__)
         assert latestLimit
@@ -87,7 +107,10 @@ class KeepLatestProtectionRule(ProtectionRule):
         self._pkgName = pkgName
         # load manifests if (TODO: if _installTime in the attrs/flavours)
         self._versionsCache = {}
-        for pkgData, manifestPath in packages(pkgName):
+        installTimes = {}
+        if preloaded is None:
+            preloaded = packages(pkgName)
+        for pkgData, manifestPath in preloaded:
             if pkgData['package'] != pkgName:
                 raise RuntimeError(f'Package manifest file {manifestPath}'
                     f' is inconsistent: defined package name is \"{pkgData["package"]}\",'
@@ -99,20 +122,44 @@ class KeepLatestProtectionRule(ProtectionRule):
                         + f' (2nd time in {manifestPath}) -- can not apply'
                         + ' "keep latest" rule.')
             assert verStr not in self._versionsCache.keys()  # guaranteed by above check
-            its  = datetime.datetime.fromisoformat(pkgData['installedAt'])
-            self._versionsCache[verStr] = copy.copy(pkgData['version'])
-            self._versionsCache[verStr]['_installTime'] = its
-            L.debug(f'Accounted {pkgName}/{verStr} installed at {its.isoformat()}')
+            # installation time is kept as ISO-8601 string: it is always
+            # written by `datetime.utcnow().isoformat()', so lexicographical
+            # comparison of strings matches chronological order
+            its  = pkgData['installedAt']
+            self._versionsCache[verStr] = pkgData['version']
+            installTimes[verStr] = its
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug(f'Accounted {pkgName}/{verStr} installed at {its}')
         self._limit = latestLimit
-        self._order = lpkgm.ordered_versions.VersionsOrder(
+        self._order = lpkgm.ordered_versions.get_versions_order(
                 attributesOrder=attrsOrder,
                 ortogonalBy=flavourFrom
                 )
-        # init order with installation time cache (supplementary)
-        self._sorted = {}
-        for flavour, linVersions in \
-                self._order(list( self._versionsCache.values()) ):
-            self._sorted[flavour] = linVersions
+        # canonic (flavour, version) tuples, computed once per version and
+        # shared among rules using same order (install time is provided as
+        # an argument, so version dicts are not copied to be annotated with
+        # it)
+        self._canonicKeys = {}
+        for verStr, pkgVer in self._versionsCache.items():
+            k = (self._order, pkgName, verStr, installTimes[verStr])
+            canonicKey = gCanonicKeys.get(k, None)
+            if canonicKey is None:
+                canonicKey = gCanonicKeys[k] \
+                        = self._order.canonic_version_tuple(pkgVer, installTimes[verStr])
+            self._canonicKeys[verStr] = canonicKey
+        # init order with installation time cache (supplementary); only
+        # `latestLimit' versions are needed per flavour. Sorted lists are
+        # retained for debug printout only, otherwise just the sets of
+        # canonic tuples of protected versions are kept
+        self._sorted = {} if L.isEnabledFor(logging.DEBUG) else None
+        self._topSets = {}
+        for flavour, linVersions in self._order.sort_keyed(
+                    ((*self._canonicKeys[verStr], pkgVer)
+                        for verStr, pkgVer in self._versionsCache.items())
+                    , topK=self._limit ):
+            self._topSets[flavour] = frozenset(item[0] for item in linVersions)
+            if self._sorted is not None:
+                self._sorted[flavour] = linVersions
 
     def __call__(self, pkgVersion):
         L = logging.getLogger(__name__)
@@ -121,34 +168,39 @@ class KeepLatestProtectionRule(ProtectionRule):
             L.warning(f'Protection rule "{self.label}": package version {self._pkgName}/{pkgVersion}'
                     + ' is not cached; will conservatively mark it as "protected".')
             return True
-        fl, ver = self._order.canonic_version_tuple(self._versionsCache[pkgVersion])
-        # based on falvour, get list of sorted versions, truncated by limit
-        linVersion = self._sorted[fl]
-        matches = ver in set(item[0] for item in self._sorted[fl][-self._limit:])
-        # ^^^ every item of linVersion is 2-tuple of:
-        #  1. N-tuple of "canonic version"
-        #  2. version dictionary
-        # elements are in the TODO order (sorted)
-        L.debug( f'Testing {pkgVersion}{str(ver)} version of {self._pkgName} with respect'
-              + ' to (sorted) versions: ' + ', '.join(f"{item[1]['fullVersion']}{str(item[0])}" for item in linVersion)
-              + f' by taking only {self._limit} most recent (go last): protected={matches}'
-              )
+        fl, ver = self._canonicKeys[pkgVersion]
+        # based on falvour, check against set of most recent versions
+        matches = ver in self._topSets[fl]
+        if L.isEnabledFor(logging.DEBUG) and self._sorted is not None:
+            # get list of sorted versions, truncated by limit; every item of
+            # linVersion is 2-tuple of:
+            #  1. N-tuple of "canonic version"
+            #  2. version dictionary
+            # elements are in the ascending order
+            linVersion = self._sorted[fl]
+            L.debug( f'Testing {pkgVersion}{str(ver)} version of {self._pkgName} with respect'
+                  + ' to (sorted) versions: ' + ', '.join(f"{item[1]['fullVersion']}{str(item[0])}" for item in linVersion)
+                  + f' being {self._limit} most recent (go last): protected={matches}'
+                  )
         return matches
 
 #                       * * *   * * *   * * *
 
+# Protection rule classes indexed by (lowercase) type name used in settings
+gProtectionRuleTypes = {}
+for _typeName in ('always', 'keep', 'system', 'keepall', 'keep_all', 'keep-all'):
+    gProtectionRuleTypes[_typeName] = KeepAll
+for _typeName in ('never', 'none'):
+    gProtectionRuleTypes[_typeName] = KeepNone
+gProtectionRuleTypes['latest'] = KeepLatestProtectionRule
+# ... other protection rules
+
 def instantiate_protection_rule(**kwargs):
-    type_ = kwargs.get('type')
-    kwargs.pop('type')
-
-    if type_.lower() in ('always', 'keep', 'system', 'keepall', 'keep_all', 'keep-all'):
-        return KeepAll(**kwargs)
-    if type_.lower() in ('never', 'none'):
-        return KeepNone(**kwargs)
-    if type_.lower() in ('latest'):
-        return KeepLatestProtectionRule(**kwargs)
-    # ... other protection rules
-    raise KeyError(type_)
+    type_ = kwargs.pop('type')
+    cls = gProtectionRuleTypes.get(type_.lower(), None)
+    if cls is None:
+        raise KeyError(type_)
+    return cls(**kwargs)
 
 #                       * * *   * * *   * * *
 
@@ -166,15 +218,9 @@ def build_protection_rules():
 
     L = logging.getLogger(__name__)
 
-    #packagesByName = defaultdict(list)  # for protection rules
-    #for pkgData, pkgFilePath in packages():
-    #    pkgName, pkgVer = pkgData['package'], pkgData['version']['fullVersion']
-    #    # append packages dict
-    #    packagesByName[pkgName].append(
-    #            ( pkgData['version']['fullVersion']
-    #            , datetime.datetime.fromisoformat(pkgData['installedAt'])
-    #            )
-    #        )
+    # installed packages manifests, indexed by package name; loaded once on
+    # demand, when first rule is instantiated
+    packagesByName = None
 
     # for every package definition in settings, construct protection rule,
     # taking into account collected version history
@@ -189,10 +235,16 @@ def build_protection_rules():
         #    continue
         # instantiate protection rules and init them with installed
         # packages data
+        if packagesByName is None:
+            packagesByName = defaultdict(list)
+            for pkgData, pkgFilePath in packages():
+                packagesByName[pkgData['package']].append((pkgData, pkgFilePath))
         for ruleDescription in pkgDef['protection-rules']:
-            ruleDescriptionDict = copy.copy(ruleDescription)
-            if 'pkgName' not in ruleDescriptionDict: ruleDescriptionDict['pkgName'] = pkgName
-            rule = instantiate_protection_rule(**ruleDescriptionDict)
+            # explicit values given in the rule description take precedence
+            rulePkgName = ruleDescription.get('pkgName', pkgName)
+            rule = instantiate_protection_rule(**{ 'pkgName': rulePkgName
+                , 'preloaded': packagesByName[rulePkgName]
+                , **ruleDescription })
             pkgProtectionRules.append(rule)
             L.debug(f'Package "{pkgName}" protected with rule "{rule.label}"')
         if not pkgProtectionRules:
@@ -202,20 +254,29 @@ def build_protection_rules():
 
 #                       * * *   * * *   * * *
 
+# Reason of package being protected from removal, as returned by
+# `PkgGraph.get_protecting_rules()': package name, version, labels of rules
+# protecting it directly and list of such tuples for packages depending on it.
+# Being a tuple, it has no per-instance dict and compares equal to plain
+# 4-tuples.
+ProtectingRules = namedtuple('ProtectingRules', ('pkgName', 'pkgVersion', 'rules', 'dependees'))
+
 def protecting_rules_report(items, indent=0):
-    returnValue = False
-    f = io.StringIO("")
+    return ''.join(_protecting_rules_report_lines(items, indent))
 
+def _protecting_rules_report_lines(items, indent, parts=None):
+    if parts is None: parts = []
+    prefix = '    '*indent
     for peName, peVer, peRules, peSub in items:
-        f.write('    '*indent + f'"{peName}/{peVer}" depends on the subject')
+        parts.append(f'{prefix}"{peName}/{peVer}" depends on the subject')
         if peRules:
-            f.write(f', is protected by rules: {", ".join(peRules)}')
+            parts.append(f', is protected by rules: {", ".join(peRules)}')
         if peSub:
-            f.write(' and provides packages:\n')
-            f.write(protecting_rules_report(peSub, indent=indent+1))
+            parts.append(' and provides packages:\n')
+            _protecting_rules_report_lines(peSub, indent+1, parts)
         else:
-            f.write('\n')
-    return f.getvalue()
+            parts.append('\n')
+    return parts
 
 # Report printing example:
 #tst = [
@@ -34,36 +34,90 @@ or subsequent use.
 # TODO: turn in-memory lists and sets into tables in DB to handle really large
 #       subtrees, provide progress indication, etc
 
-import os, sys, copy
-import glob, base64, hashlib, filecmp, pathlib, json, copy, logging \
-     , itertools, shutil, gzip, pickle, functools, fnmatch
+import os, sys, copy, errno, re
+import glob, hashlib, filecmp, json, copy, logging, base64 \
+     , shutil, gzip, pickle, functools, fnmatch, mmap \
+     , concurrent.futures, collections
 
 #import sqlite3  # TODO: optional
+try:
+    import xxhash  # optional, for fast non-cryptographic hashing
+except ImportError:
+    xxhash = None
+
+# Hashing algorithm used to compare files and directories. SHA-256 is
+# hardware-accelerated on most of the modern CPUs and its collision
+# probability is negligible, so entries of same size and digest are considered
+# identical without byte-by-byte comparison. If ``xxhash`` module is
+# available, much faster (but non-cryptographic) ``xxh3_128`` can be chosen
+# instead; entries of matching digests are then verified by comparing their
+# content.
+gHashAlgo = 'sha256'
+
+# Hashing algorithms which digests are considered as a proof of identity
+gCollisionResistantHashAlgos = ('sha256',)
+
+# If set, digests of any algorithm are considered as a proof of identity (no
+# content comparison is done); must be explicitly requested by user
+gTrustDigests = False
+
+def digests_trusted():
+    """
+    Returns whether entries of same size and digest can be considered
+    identical without comparing their content.
+    """
+    return gTrustDigests or gHashAlgo in gCollisionResistantHashAlgos
+
+def new_hash():
+    """
+    Returns new hash object of algorithm defined by ``gHashAlgo``.
+    """
+    if gHashAlgo.startswith('xxh'):
+        if xxhash is None:
+            raise RuntimeError(f'Hashing algorithm "{gHashAlgo}" requires'
+                    ' `xxhash\' Python module.')
+        return getattr(xxhash, gHashAlgo)()
+    return hashlib.new(gHashAlgo)
+
+# Buffer size used to read files that can not be memory-mapped
+gReadBufferSize = 1024*1024
 
-def file_md5(path, stack=None):
+def file_digest(path):
     """
-    For given file, calculates MD5 sum, returns its stringified digest.
+    For given file, calculates hash sum, returns its digest.
+
+    Non-empty regular files are memory-mapped and fed to the hash at once,
+    other files are read in large chunks.
     """
-    if not stack: stack = []
+    fileHash = new_hash()
     with open(path, "rb") as f:
-        fileHash = hashlib.md5()
-        while chunk := f.read(8192):
+        mm = None
+        if os.fstat(f.fileno()).st_size:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                pass  # not mappable, read it instead
+        if mm is not None:
+            with mm:
+                if hasattr(mm, 'madvise'):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                fileHash.update(mm)
+            return fileHash.digest()
+        while chunk := f.read(gReadBufferSize):
             fileHash.update(chunk)
-            for s in stack:
-                s.update(chunk)
     return fileHash.digest()
 
 def files_stats_in(pattern):
     """
     For given shell wildcard pattern, returns recursive scan of the directory,
-    containing tuples with: (path, size, md5sum).
+    containing tuples with: (path, size, digest).
     """
     for filePath in glob.glob(pattern):
         if not os.path.isfile(filePath):
             continue
         size = os.path.getsize(filePath)
-        md5sum = file_md5(filePath)
-        yield (filePath, size, md5sum)
+        digest = file_digest(filePath)
+        yield (filePath, size, digest)
 
 def are_hardlinked(a, b):
     if not (os.path.isfile(a) and os.path.isfile(b)): return False
@@ -75,80 +129,178 @@ def is_subpath_of(subj, parent, ifSame=True):
     if subj == parent: return ifSame
     return subj.startswith(parent)
 
+def _scan_fs_subtree(path, symlinks, dirsFilter, filePaths):
+    """
+    Aux function for ``dfs_fs_items()``: lists directory entries of the
+    subtree without reading files. Returns nested tuple
+    ``(path, [(dirName, subtree), ...], [(fileName, size), ...], [linkName, ...])``;
+    ``(absPath, size, (device, inode))`` of the files are appended to
+    ``filePaths``.
+
+    Traversal is iterative (does not recurse), so subtree depth is not limited
+    by the interpreter's recursion limit.
+    """
+    root = (path, [], [], [])
+    pending = [root]
+    while pending:
+        path, subDirs, filesAndSizes, links = pending.pop()
+        # type and size of the entries are obtained from directory listing
+        # (and single stat() call per file, if need)
+        with os.scandir(path) as it:
+            for entry in it:
+                followLinks = False
+                if entry.is_symlink():
+                    if 'consider' == symlinks:
+                        links.append(entry.name)
+                    if symlinks in ('consider', 'ignore'):
+                        continue
+                    else:
+                        assert symlinks == 'dereference'
+                        followLinks = True
+                if entry.is_file(follow_symlinks=followLinks):
+                    st = entry.stat(follow_symlinks=followLinks)
+                    filesAndSizes.append((entry.name, st.st_size))
+                    filePaths.append((entry.path, st.st_size
+                        , (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)))
+                    continue
+                if entry.is_dir(follow_symlinks=followLinks):
+                    if dirsFilter and not dirsFilter(entry.path): continue  # omit dir
+                    # sub-directory node is filled when popped from pending
+                    subtree = (entry.path, [], [], [])
+                    subDirs.append((entry.name, subtree))
+                    pending.append(subtree)
+                    continue
+    return root
+
+def _dfs_scanned_items( subtree, root, digests
+                      , yieldFiles, yieldDirs, filesFilter
+                      , _cache ):
+    """
+    Aux generator for ``dfs_fs_items()``: iterates over subtree returned by
+    ``_scan_fs_subtree()`` using pre-computed file digests. Returns
+    ``(digest, size)`` of the subtree's root directory.
+
+    Directory digest is computed from sorted list of its entries (name, type
+    and digest of every sub-directory and file, target of every symlink), so
+    identical subtrees result in identical digests. Files missing in
+    ``digests`` (not hashed) are yielded with ``None`` digest and make
+    directory digest unique by their path.
+
+    Uses explicit stack of ``[subtree, nextSubDirIndex, entries, size]``
+    instead of recursion.
+    """
+    stack = [[subtree, 0, [], 0]]
+    while True:
+        frame = stack[-1]
+        (path, subDirs, files, links), nSubDir = frame[0], frame[1]
+        if nSubDir < len(subDirs):
+            # descend into next sub-directory first
+            frame[1] += 1
+            stack.append([subDirs[nSubDir][1], 0, [], 0])
+            continue
+        # all sub-directories are done, process files and links
+        entries, size = frame[2], frame[3]
+        for fileItem, fileSize in files:
+            absPath = os.path.join(path, fileItem)
+            digest = digests.get(absPath, None)
+            relPath = os.path.relpath(absPath, root)
+            if digest is not None:
+                entries.append(os.fsencode(fileItem) + b'\0f' + digest)
+            else:
+                entries.append(os.fsencode(fileItem) + b'\0u' + os.fsencode(absPath))
+            size += fileSize
+            if not filesFilter or filesFilter(absPath):
+                r = ('f', relPath, digest, fileSize, None)
+                if _cache: _cache.add(*r)
+                if yieldFiles: yield r
+        for linkItem in links:
+            absPath = os.path.join(path, linkItem)
+            relPath = os.path.relpath(absPath, root)
+            r = ('l', relPath, None, None, os.path.normpath(os.readlink(absPath)))
+            if _cache: _cache.add(*r)
+            yield r
+            # ^^^ NOTE: readlink always resolves only 1 lvl
+            entries.append(os.fsencode(linkItem) + b'\0l' + os.fsencode(r[4]))
+        dirHash = new_hash()
+        for entry in sorted(entries):
+            dirHash.update(entry)
+            dirHash.update(b'\0')
+        dirDigest = dirHash.digest()
+        stack.pop()
+        if not stack:
+            return dirDigest, size
+        # account directory in the parent
+        parent = stack[-1]
+        dirItem = os.path.basename(path)
+        relPath = os.path.relpath(path, root)
+        r = ('d', relPath, dirDigest, size, None)
+        if _cache: _cache.add(*r)
+        if yieldDirs: yield r
+        parent[2].append(os.fsencode(dirItem) + b'\0d' + dirDigest)
+        parent[3] += size
+
 def dfs_fs_items( path
                 , root=None
                 , symlinks='consider'
                 , yieldFiles=True, yieldDirs=True
                 , filesFilter=None, dirsFilter=None
-                , md5Stack=None, sizesStack=None
+                , nThreads=None
+                , onlyDuplicateSizes=False
+                , inodeDigests=None
                 , _cache=None
                 ):
     """
     Iterates FS subtree entries recursively in depth-first search (DFS) order.
     Yielded tuple:
-        (type:'d|f|l', path:str, md5-digest:bytes, size:int)
+        (type:'d|f|l', path:str, digest:bytes, size:int)
 
     Use ``filesFilter`` and ``dirsFilter`` callables to omit certain files and
     direcotries. These callables are invoked
     with absolute path and shall return whether or not file or directory is
     considered.
+
+    Subtree is listed first, then files are hashed in parallel by pool of
+    ``nThreads`` threads (hashing and reading release the GIL). If
+    ``nThreads`` is not given, ``min(32, 4*nCPUs)`` is used.
+
+    If ``onlyDuplicateSizes`` is set, only files which size matches size of
+    some other file in the subtree are hashed; for other files ``None`` is
+    yielded instead of digest (they can not have duplicates within the
+    subtree anyway).
+
+    Hardlinked files (same device and inode) are hashed once. Digests are
+    cached in ``inodeDigests`` dict, indexed by ``(device, inode, size,
+    mtime)`` tuple, if it is given (so one can share it among multiple calls,
+    or keep it from previous run to hash only modified files).
     """
     assert symlinks in ('consider', 'dereference', 'ignore')
     if root is None: root = path
-    if md5Stack is None:    md5Stack = [hashlib.md5(),]
-    if sizesStack is None:  sizesStack = [0,]
-    fsItems = os.listdir(path)
-    files, dirs, links = [], [], []
-    for item in fsItems:
-        p = os.path.join(path, item)
-        if os.path.islink(p):
-            if 'consider' == symlinks:
-                links.append(item)
-            if symlinks in ('consider', 'ignore'):
-                continue
-            else:
-                assert symlinks == 'dereference'
-                p = os.path.abspath(p)
-        if os.path.isfile(p):
-            files.append(item)
-            continue
-        if os.path.isdir(p):
-            dirs.append(item)
-            continue
-    for dirItem in dirs:
-        if dirsFilter and not dirsFilter(os.path.join(path, dirItem)): continue  # omit dir
-        md5Stack.append(hashlib.md5())
-        sizesStack.append(0)
-        yield from dfs_fs_items(os.path.join(path, dirItem), root=root
-            , yieldFiles=yieldFiles, yieldDirs=yieldDirs
-            , filesFilter=filesFilter, dirsFilter=dirsFilter
-            , md5Stack=md5Stack, sizesStack=sizesStack
-            , _cache=_cache
-            )
-        relPath = os.path.relpath(os.path.join(path, dirItem), root)
-        r = ('d', relPath, md5Stack[-1].digest(), sizesStack[-1], None)
-        if _cache: _cache.add(*r)
-        if yieldDirs: yield r
-        md5Stack.pop()
-        sizesStack.pop()
-    for fileItem in files:
-        absPath = os.path.join(path, fileItem)
-        md5 = file_md5(absPath, stack=md5Stack)
-        relPath = os.path.relpath(absPath, root)
-        size = os.path.getsize(absPath)
-        for n in range(len(sizesStack)):
-            sizesStack[n] += size
-        if not filesFilter or filesFilter(absPath):
-            r = ('f', relPath, md5, size, None)
-            if _cache: _cache.add(*r)
-            if yieldFiles: yield r
-    for linkItem in links:
-        absPath = os.path.join(path, linkItem)
-        relPath = os.path.relpath(absPath, root)
-        r = ('l', relPath, None, None, os.path.normpath(os.readlink(absPath)))
-        if _cache: _cache.add(*r)
-        yield r
-        # ^^^ NOTE: readlink always resolves only 1 lvl
+    filePaths = []
+    subtree = _scan_fs_subtree(path, symlinks, dirsFilter, filePaths)
+    if onlyDuplicateSizes:
+        sizeCounts = collections.Counter(size for _, size, _ in filePaths)
+        filePaths = list(item for item in filePaths if sizeCounts[item[1]] > 1)
+    if inodeDigests is None: inodeDigests = {}
+    # group files by inode, to hash only first path of every not yet known one
+    pathsByInode = {}
+    for filePath, _, inode in filePaths:
+        pathsByInode.setdefault(inode, []).append(filePath)
+    toHash = list((inode, paths[0]) for inode, paths in pathsByInode.items()
+            if inode not in inodeDigests)
+    if nThreads is None: nThreads = min(32, (os.cpu_count() or 1)*4)
+    if nThreads > 1 and len(toHash) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor:
+            inodeDigests.update(zip((inode for inode, _ in toHash)
+                    , executor.map(file_digest, (filePath for _, filePath in toHash))))
+    else:
+        inodeDigests.update((inode, file_digest(filePath)) for inode, filePath in toHash)
+    digests = {}
+    for inode, paths in pathsByInode.items():
+        for filePath in paths:
+            digests[filePath] = inodeDigests[inode]
+    yield from _dfs_scanned_items(subtree, root, digests
+            , yieldFiles, yieldDirs, filesFilter
+            , _cache)
 
 
 #class MemoryFSCache(object):
@@ -175,13 +327,56 @@ def dfs_fs_items( path
 #        cur = self._con.cursor()
 #
 #        cmd = 'CREATE TABLE IF NOT EXISTS fsitems (' \
-#            + 'parent INT, type INT, path TEXT, size INT, md5sum BLOB, linkdest TEXT);'
+#            + 'parent INT, type INT, path TEXT, size INT, digest BLOB, linkdest TEXT);'
 #        cur.execute(cmd)
 #
 #        cmd = 'CREATE TABLE IF NOT EXISTS matches (' \
 #            + 'a INT, b INT;'
 #        cur.execute(cmd)
 
+def trees_identical(pathA, pathB):
+    """
+    Compares two FS subtrees entry by entry: names, types, symbolic links
+    targets and files content (byte-by-byte). Used to verify directories of
+    matching digests when digests are not trusted (see ``digests_trusted()``).
+    """
+    try:
+        with os.scandir(pathA) as it: entriesA = dict((e.name, e) for e in it)
+        with os.scandir(pathB) as it: entriesB = dict((e.name, e) for e in it)
+    except OSError:
+        return False
+    if entriesA.keys() != entriesB.keys(): return False
+    for name, eA in entriesA.items():
+        eB = entriesB[name]
+        if eA.is_symlink() or eB.is_symlink():
+            if not (eA.is_symlink() and eB.is_symlink()) \
+            or os.readlink(eA.path) != os.readlink(eB.path):
+                return False
+        elif eA.is_dir():
+            if not eB.is_dir() or not trees_identical(eA.path, eB.path):
+                return False
+        elif eA.is_file():
+            if not eB.is_file() or not filecmp.cmp(eA.path, eB.path, shallow=False):
+                return False
+        else:
+            return False  # special files are not compared
+    return True
+
+def _split_identical(paths, are_identical):
+    """
+    Splits list of paths into lists of identical items, by comparing every
+    item with first item of each list found so far.
+    """
+    groups = []
+    for p in paths:
+        for group in groups:
+            if are_identical(group[0], p):
+                group.append(p)
+                break
+        else:
+            groups.append([p])
+    return groups
+
 def find_duplicates_in( path
         , reduceDirs=True
         , **kwargs
@@ -199,130 +394,92 @@ def find_duplicates_in( path
     TODO: switchg to DB or DB-like interface may severely affect this code...
     """
     L = logging.getLogger(__name__)
-    # collect items with matching size and md5 sum
-    itemsBySizeAndMD5 = {}
-    fsItems = list(dfs_fs_items(path, **kwargs))  # cache subtree iteration result
-    for fsType, relPath, md5, size, _ in fsItems:
+    # collect items with matching size and digest
+    itemsBySizeAndDigest = {}
+    # bucket items as they are yielded; files of unique size are not hashed
+    # as they can not have duplicates
+    nItems = 0
+    for fsType, relPath, digest, size, _ in dfs_fs_items(path, onlyDuplicateSizes=True, **kwargs):
+        nItems += 1
+        if 0 == nItems % 10000:
+            L.info(f'{nItems} FS entries considered in "{path}"')
         if fsType == 'l':
             # Links does not affect the similarity here (directories with matching
-            # size and md5 and different links will be compared anyway)
+            # size and digest and different links will be compared anyway)
             continue
-        k = (fsType, size, md5)
-        if k in itemsBySizeAndMD5:
-            itemsBySizeAndMD5[k].append(relPath)
+        if digest is None: continue  # file of unique size
+        k = (fsType, size, digest)
+        if k in itemsBySizeAndDigest:
+            itemsBySizeAndDigest[k].append(relPath)
         else:
-            itemsBySizeAndMD5[k] = [relPath,]
-    # process possibly identic dirs: to identify two or more directories as
-    # identical we require them all to have the same subtree
-    maybeIdenticDirs = {}
+            itemsBySizeAndDigest[k] = [relPath,]
+    # items of same size and digest are identical if digests are trusted,
+    # otherwise they are split into groups of items with identical content
+    trusted = digests_trusted()
+    def _identical_groups(candidates, are_identical):
+        if trusted: return [candidates]
+        groups = _split_identical(candidates
+                , lambda a, b: are_identical(os.path.join(path, a), os.path.join(path, b)))
+        if L.isEnabledFor(logging.INFO) and len(groups) > 1:
+            L.info('Note: items have same digest and size, but differ in'
+                    ' their content: ' + ', '.join(candidates))
+        return groups
+    # process identic dirs: directory digest is computed from names, types
+    # and digests of all the entries in its subtree, so directories of same
+    # size and (trusted) digest are identical and no pairwise comparison is
+    # needed
     identicalDirs = []
     if reduceDirs:
-        for (t, size, md5), candidates in itemsBySizeAndMD5.items():
-            if 'd' == t: maybeIdenticDirs[(size, md5)] = copy.copy(candidates)
-        for (_, md5), paths in maybeIdenticDirs.items():
-            for a, b in itertools.combinations(paths, 2):
-                # TODO: check if symbolic links to each other
-                fullPathA = os.path.join(path, a)
-                fullPathB = os.path.join(path, b)
-                dirDiff = DirDiff( fullPathA
-                                 , fullPathB
-                                 , **kwargs)
-                # ^^^ TODO: benefit from cache
-                if dirDiff.isIdentical:
-                    L.debug(f'Identical directories: {a} and {b}')
-                    added = False
-                    for group in identicalDirs:
-                        if a in group or b in group:
-                            group.add(a)
-                            group.add(b)
-                            added = True
-                    if not added:
-                        identicalDirs.append(set([a, b]))
-                else:
-                    L.debug('Directories differ although size and'
-                            + f' hashsums match: {a} and {b}')
-    # among matching file items, perform direct comparison to obtain identical
-    # files
+        for (t, size, digest), candidates in itemsBySizeAndDigest.items():
+            if 'd' != t or len(candidates) < 2: continue
+            for group in _identical_groups(candidates, trees_identical):
+                if len(group) < 2: continue
+                L.debug('Identical directories: ' + ', '.join(group))
+                identicalDirs.append(set(group))
+    # index of duplicating directories group, by directory path
+    dirGroupOf = {}
+    for nGroup, group in enumerate(identicalDirs):
+        for dirPath in group:
+            dirGroupOf[dirPath] = nGroup
+    # group identical files
     identicalFiles = []
-    for (t, size, md5), candidates in itemsBySizeAndMD5.items():
+    for (t, size, digest), sameDigest in itemsBySizeAndDigest.items():
         if 'f' != t: continue
-        if len(candidates) == 1: continue  # omit unique items
-        equivalents = []
-        # iterate over all pairwise combinations of files, possibly omitting
-        # cases from duplicating dirs
-        # TODO: code seems dirty and bogus, rethink/rewrite
-        for pair in itertools.combinations(candidates, 2):
+        if len(sameDigest) == 1: continue  # omit unique items
+        for candidates in _identical_groups(sameDigest
+                , lambda a, b: filecmp.cmp(a, b, shallow=False)):
+            if len(candidates) == 1: continue
             if reduceDirs:
-                fromDupDir = False
-                dirA = os.path.dirname(pair[0])
-                dirB = os.path.dirname(pair[1])
-                # check, if pair of files belongs to duplicating dir
-                for group in identicalDirs:
-                    #assert len(group) > 2
-                    if dirA in group and dirB in group:
-                        fromDupDir = True
-                        break
-                if fromDupDir:
+                # Pairs of files from the same group of duplicating dirs are
+                # not considered as duplicates, while any two files from
+                # different groups (or from non-duplicating dirs) are.
+                # Therefore all the candidates are duplicates (directly or
+                # via file from another group) unless they all belong to the
+                # single group.
+                fileDirGroups = set(dirGroupOf.get(os.path.dirname(c), (None, c))
+                                    for c in candidates)
+                if len(fileDirGroups) < 2:
                     L.debug('Skipping identical files from duplicating'
-                                + f' directories: {pair[0]}, {pair[1]}')
+                            + ' directories: ' + ', '.join(candidates))
                     continue
-            a = os.path.join(path, pair[0])
-            b = os.path.join(path, pair[1])
-            if filecmp.cmp(a, b, shallow=False):
-                # a and b are identical -- true duplicate -- find appropriate
-                # set with equivalents and append it
-                appended = False
-                for c in equivalents:
-                    if a in c:
-                        c.add(b)
-                        appended = True
-                        break
-                    if b in c:
-                        c.add(a)
-                        appended = True
-                        break
-                if not appended:
-                    equivalents.append(set([a, b]))
-            else:
-                # a and b actually different, despite their size and md5 match
-                # This is a noteworthy event to be printed.
-                L.info('Note: files have same MD5 sum and size, but'
-                        + f' differ in their content: "{a}" and "{b}"')
-                # - a
-                appended = False
-                for c in equivalents:
-                    if a in c:
-                        c.add(a)
-                        appended = True
-                        break
-                if not appended:
-                    equivalents.append(set([a,]))
-                # - b
-                appended = False
-                for c in equivalents:
-                    if b in c:
-                        c.add(b)
-                        appended = True
-                        break
-                if not appended:
-                    equivalents.append(set([b,]))
-        # equivalents now has groups if identical files (including trivial ones
-        # with unique files)
-        for identicalFilesSubGroup in equivalents:
-            if len(identicalFilesSubGroup) == 1: continue  # omit trivial ones
-            identicalFiles.append(identicalFilesSubGroup)
+            identicalFiles.append(set(os.path.join(path, c) for c in candidates))
     return identicalFiles, identicalDirs
 
 def _resolve_source(items, sourceResolvers, fsItemsStr=None):
+    """
+    Returns ``(orig, ruleName)`` for the first resolver in ``sourceResolvers``
+    which chosen single original item among ``items`` (expected to be sorted
+    tuple of paths), or ``(None, None)``.
+    """
     L = logging.getLogger(__name__)
     for srName, sr in sourceResolvers:
-        orig = sr(sorted(items))
+        orig = sr(items)
         if orig and type(orig) in (list, tuple) and 1 == len(orig):
             orig = orig[0]
         if type(orig) is str:
             L.debug('%s group %s resolved into %s by rule "%s"'%(
                 'FS items' if fsItemsStr is None else fsItemsStr
-                , ', '.join(sorted(items)), orig, srName))
+                , ', '.join(items), orig, srName))
             return orig, srName
     return None, None
 
@@ -334,11 +491,11 @@ def write_duplicates_report_ascii(stream
     if duplicates:
         if not sourceResolvers: sourceResolvers = []
         if not forceKeep: forceKeep = []
-        for nGroup, dups in enumerate(sorted(duplicates[0])):
+        for nGroup, dups in enumerate(sorted(tuple(sorted(g)) for g in duplicates[0])):
             assert dups
             orig, srName = _resolve_source( dups, sourceResolvers, fsItemsStr='Files')
             stream.write(f'# files group #{nGroup}:\n')
-            for dupItem in sorted(dups):
+            for dupItem in dups:
                 if dupItem != orig:
                     if dupItem in forceKeep:
                         stream.write(f' == {dupItem}\n')
@@ -348,11 +505,11 @@ def write_duplicates_report_ascii(stream
                     stream.write(f' -> {dupItem} (choosen by "{srName}")\n')
         if not duplicates[0]:
             stream.write('# no duplicating files\n')
-        for nGroup, dups in enumerate(sorted(duplicates[1])):
+        for nGroup, dups in enumerate(sorted(tuple(sorted(g)) for g in duplicates[1])):
             assert dups
             orig, srName = _resolve_source( dups, sourceResolvers, fsItemsStr='Dirs')
             stream.write(f'# directories group #{nGroup}:\n')
-            for dupItem in sorted(dups):
+            for dupItem in dups:
                 if dupItem != orig:
                     if dupItem in forceKeep:
                         stream.write(f' == {dupItem}\n')
@@ -369,42 +526,40 @@ def write_duplicates_report_ascii(stream
 def write_duplicates_report_json(stream, duplicates):
     pass
 
+# Properties of FS entry in subtree index built by ``fs_tree()``
+OwnProps = collections.namedtuple('OwnProps'
+        , ('path', 'size', 'digest', 'fsType', 'linkTarget'))
+
+# Version of dict produced by ``DirDiff.serializable_dict()``; diffs saved in
+# other versions can not be restored
+gSerializationFormatVersion = 2
+
 def fs_tree(basePath, iterable):
     """
-    Builds dictionary from FS subtree. Arguments are the same as
-    for ``dfs_fs_items()``. Returned dict will reflect subtree with keys
-    matching file names and a special property ``!ownProps`` containing
-    size, md5, etc.
+    Builds flat index of FS subtree from iterable of items yielded by
+    ``dfs_fs_items()``. Returned dict contains:
+        - ``items`` -- properties of every entry (``OwnProps`` tuple of
+          path, size, digest, etc) indexed by entry's relative path;
+        - ``children`` -- lists of names of directory entries, indexed by
+          relative path of the directory (``''`` for ``basePath`` itself).
     """
-    r = {}
-    for fsType, relPath, md5, size, linkTarget in iterable:
-        relPath = os.path.normpath(relPath)
-        pathTokens = tuple(pathlib.PurePosixPath(relPath).parts)
-        obj = {
-                'path': relPath,
-                'origPath': os.path.join(basePath, relPath),
-                'size': size,
-                'md5sum': md5,  #hashlib.md5(md5).hexdigest(),
-                'nUses': 0,
-                'meta': None,  # TODO
-                'fsType': fsType,
-                'linkTarget': linkTarget
-            }
-        c = r
-        for k in pathTokens:
-            c_ = c.get(k, None)
-            if c_ is None:
-                c[k] = {}
-            c = c[k]
-        c['!ownProps'] = obj
-    return r
+    items, children = {}, {'': []}
+    for fsType, relPath, digest, size, linkTarget in iterable:
+        # paths are interned as same relative paths usually appear in both
+        # compared subtrees
+        relPath = sys.intern(os.path.normpath(relPath))
+        items[relPath] = OwnProps(relPath, size, digest, fsType, linkTarget)
+        parentPath, name = os.path.split(relPath)
+        children.setdefault(parentPath, []).append(name)
+        if 'd' == fsType: children.setdefault(relPath, [])
+    return {'items': items, 'children': children}
 
 class DirDiff(object):
     """
     Represents recursive differences between two directories.
 
     Inspired by ``filecmp.dircmp()`` and some other solutions, this class
-    exploits MD5-based caching to recursively compare two directories with
+    exploits hash-based caching to recursively compare two directories with
     sub-structure, figuring out identical branches.
 
     The primary usage scenario is to maintain directories with large amount
@@ -444,56 +599,73 @@ class DirDiff(object):
             }
 
     def __init__(self, pathA, pathB, recursive=True, a=None, b=None
-            , _savedObj=None, **kwargs):
+            , _savedObj=None, _relPath='', **kwargs):
+        """
+        Compares directories ``pathA`` and ``pathB``. Subtree indexes built
+        by ``fs_tree()`` can be given as ``a`` and ``b`` to avoid scanning;
+        ``_relPath`` is used by nested instances to refer to sub-directories
+        within these (shared) indexes.
+        """
         L = logging.getLogger(__name__)
         self._pathA = pathA
         self._pathB = pathB
         if os.path.realpath(pathA) == os.path.realpath(pathB):
             raise RuntimeError(f'Can not compare same directory: both "{pathA}"'
                     + f' and "{pathB}" resolved to "{os.path.realpath(pathA)}".')
-        # scan dirs if result not given
-        if a is None: a = fs_tree(pathA, dfs_fs_items(pathA, **kwargs))
+        # scan dirs if result not given; files hardlinked between the dirs
+        # are hashed once
+        scanKwargs = dict(kwargs)
+        scanKwargs.setdefault('inodeDigests', {})
+        self._digestCache = scanKwargs['inodeDigests']
+        if a is None: a = fs_tree(pathA, dfs_fs_items(pathA, **scanKwargs))
         self._a = a
-        if b is None: b = fs_tree(pathB, dfs_fs_items(pathB, **kwargs))
+        if b is None: b = fs_tree(pathB, dfs_fs_items(pathB, **scanKwargs))
         self._b = b
+        self._relPath = _relPath
         # find identic directories
-        itemsA, itemsB = [], []
-        for k in self._a.keys():
-            if k.startswith('!'): continue
-            itemsA.append((k, self._a[k]['!ownProps']['fsType']))
-        for k in self._b.keys():
-            if k.startswith('!'): continue
-            itemsB.append((k, self._b[k]['!ownProps']['fsType']))
-        itemsA, itemsB = set(itemsA), set(itemsB)
+        itemsA = set((k, self._own_props(a, k).fsType) for k in a['children'].get(_relPath, ()))
+        itemsB = set((k, self._own_props(b, k).fsType) for k in b['children'].get(_relPath, ()))
         self._onlyInA = itemsA - itemsB
         self._onlyInB = itemsB - itemsA
         self._common  = itemsA & itemsB  # only common names
-        # among common entries, compare sizes and hashsums
+        # among common entries, compare sizes and hashsums; if digests are not
+        # trusted, content of matching files and dirs is compared as well
+        # (unless diff is restored from saved object, as entries may be gone)
+        verify = _savedObj is None and not digests_trusted()
         mayBeIdentic = []
         for k, fsType in self._common:
+            propsA, propsB = self._own_props(a, k), self._own_props(b, k)
             if fsType == 'l':
                 # symlinks are considered identic when they do refer to the
                 # same target
-                assert k in self._a.keys()
-                assert k in self._b.keys()
-                if self._a[k]['!ownProps']['linkTarget'] != self._b[k]['!ownProps']['linkTarget']:
+                if propsA.linkTarget != propsB.linkTarget:
                     L.debug(f'Links "{k}" refer to different targets:'
-                            + f' \"{self._a[k]["!ownProps"]["linkTarget"]}\" from {os.path.join(self._pathA, k)} and'
-                            + f' \"{self._b[k]["!ownProps"]["linkTarget"]}\" from {os.path.join(self._pathB, k)}')
+                            + f' \"{propsA.linkTarget}\" from {os.path.join(self._pathA, k)} and'
+                            + f' \"{propsB.linkTarget}\" from {os.path.join(self._pathB, k)}')
                     continue
-            if self._a[k]['!ownProps']['size']    != self._b[k]['!ownProps']['size']:
+            if propsA.size    != propsB.size:
                 L.debug(f'FS items differ in size: {k}')
                 continue
-            if self._a[k]['!ownProps']['md5sum']  != self._b[k]['!ownProps']['md5sum']:
-                L.debug(f'FS items differ in md5: {k}')
+            if propsA.digest  != propsB.digest:
+                L.debug(f'FS items differ in digest: {k}')
                 continue
-            L.debug(f'FS items may be identical (size and md5 match or link target match): {k}')
+            if verify and fsType in 'fd':
+                fullPathInA = os.path.join(pathA, k)
+                fullPathInB = os.path.join(pathB, k)
+                if not (trees_identical(fullPathInA, fullPathInB) if 'd' == fsType
+                        else filecmp.cmp(fullPathInA, fullPathInB, shallow=False)):
+                    L.info('Note: items have same digest and size, but differ in'
+                            f' their content: {fullPathInA} and {fullPathInB}')
+                    continue
+            L.debug(f'FS items may be identical (size and digest match or link target match): {k}')
             mayBeIdentic.append((k, fsType))
             # NOTE: obtain different eponymous as (self._common - mayBeIdentic)
         self._recursive = recursive
-        if not recursive:
-            self._mayBeIdentic = set(mayBeIdentic)
-        else:
+        # digest of a directory is computed from its entire subtree, so
+        # sub-directories in this set are identical (verified, if digests are
+        # not trusted)
+        self._mayBeIdentic = set(mayBeIdentic)
+        if recursive:
             # Otherwise, perform recursive traversal
             # 1. compare files in this dir
             self._identicFiles = set()
@@ -512,32 +684,52 @@ class DirDiff(object):
                         self._identicFiles.add((maybeIdenticFile, 'l'))
                         L.debug(f'Links are identical: {fullPathInA}, {fullPathInB}')
                         continue
-                    if are_hardlinked(fullPathInA, fullPathInB) \
-                    or filecmp.cmp(fullPathInA, fullPathInB, shallow=False):
-                        # files match
-                        self._identicFiles.add((maybeIdenticFile, 'f'))
-                        L.debug(f'Files are truly identical: {fullPathInA} {fullPathInB}')
-                    else:
-                        L.debug(f'Files differ: {fullPathInA} {fullPathInB}')
+                    # files of same size and digest match (content is
+                    # verified above, if digests are not trusted)
+                    self._identicFiles.add((maybeIdenticFile, 'f'))
+                    L.debug(f'Files are identical: {fullPathInA} {fullPathInB}')
             else:
-                self._identicFiles = set(_savedObj['identicFiles'])
-            # 2. compare directories using this class
-            subDirs = set(nm for nm, fsType in (itemsA & itemsB) if 'd' == fsType)
+                # (name, type) pairs become lists when saved as JSON
+                self._identicFiles = set(tuple(item) for item in _savedObj['identicFiles'])
+            # 2. compare directories using this class; sub-diffs are
+            #    created on demand (see _get_subdiff())
+            self._subDirs = set(nm for nm, fsType in (itemsA & itemsB) if 'd' == fsType)
             self._subDiff = {}
-            for maybeIdenticDir in subDirs:
-                # compare two files
-                fullPathInA = os.path.join(pathA, maybeIdenticDir)
-                fullPathInB = os.path.join(pathB, maybeIdenticDir)
-                if not _savedObj:
-                    self._subDiff[maybeIdenticDir] = DirDiff(fullPathInA, fullPathInB
-                        , recursive=self._recursive
-                        , **kwargs)
-                else:
-                    self._subDiff[maybeIdenticDir] = DirDiff(fullPathInA, fullPathInB
-                        , a=a[maybeIdenticDir], b=b[maybeIdenticDir]
-                        , recursive=self._recursive
-                        , _savedObj=_savedObj['sub'][maybeIdenticDir]
-                        , **kwargs)
+            self._savedSubs = _savedObj['sub'] if _savedObj else {}
+            self._kwargs = kwargs
+
+    def _get_subdiff(self, name):
+        """
+        Returns (cached) diff object of common sub-directory.
+        """
+        subDiff = self._subDiff.get(name, None)
+        if subDiff is None:
+            # compare two directories, re-using subtree indexes
+            subDiff = self._subDiff[name] = DirDiff(
+                      os.path.join(self._pathA, name)
+                    , os.path.join(self._pathB, name)
+                    , a=self._a, b=self._b
+                    , recursive=self._recursive
+                    , _savedObj=self._savedSubs.get(name, None)
+                    , _relPath=os.path.join(self._relPath, name)
+                    , **self._kwargs)
+        return subDiff
+
+    @property
+    def digestCache(self):
+        """
+        Digests of files hashed while scanning, indexed by ``(device, inode,
+        size, mtime)``. Can be given as ``inodeDigests`` to re-scan
+        directories without hashing unchanged files.
+        """
+        return self._digestCache
+
+    def _own_props(self, tree, name):
+        """
+        Returns properties of the entry of this (sub-)directory from given
+        subtree index.
+        """
+        return tree['items'][os.path.join(self._relPath, name)]
 
     @functools.cached_property
     def isIdentical(self):
@@ -552,11 +744,9 @@ class DirDiff(object):
         # dirs not being identical
         if self._identicFiles != set(c for c in self._common if c[1] in 'lf'):
             return False
-        # if any of the subdir is not identical, this (parent) is not identical
-        for subDiff in self._subDiff.values():
-            if not subDiff.isIdentical: return False
-        # dirs are identical
-        return True
+        # sub-directories are identical if their digests match, no need to
+        # traverse sub-diffs
+        return all(c in self._mayBeIdentic for c in self._common if 'd' == c[1])
 
     @property
     def a(self):
@@ -572,7 +762,7 @@ class DirDiff(object):
             # todo: well, for flat directories it still may have sense...
             raise RuntimeError('Can not determine if dirs are identic as object'
                     ' is not recusrsive')
-        return set(nm for nm, dirItem in self._subDiff.items() if dirItem.isIdentical)
+        return set(nm for nm, t in self._mayBeIdentic if 'd' == t)
 
     @property
     def identicLinks(self):
@@ -584,11 +774,11 @@ class DirDiff(object):
 
     @functools.cached_property
     def differentDirs(self):
-        return set(nm for nm in self._subDiff.keys()) - self.identicDirs
+        return self._subDirs - self.identicDirs
 
     @functools.cached_property
     def nonTrivialDiffs(self):
-        return dict((k, self._subDiff[k]) for k in self.differentDirs)
+        return dict((k, self._get_subdiff(k)) for k in self.differentDirs)
 
     @property
     def identicFiles(self):
@@ -618,28 +808,36 @@ class DirDiff(object):
         elif type(colors) is bool and colors:
             colors = self.__class__.reportColors
         assert type(colors) is dict
+        # report is collected and written at once
+        stream.write(''.join(self._report_lines([], nIndent, onlyDiff, colors, labels)))
+
+    def _report_lines(self, lines, nIndent, onlyDiff, colors, labels):
+        """
+        Appends lines of ``print_report()`` to ``lines`` list, recursively for
+        different sub-directories. Returns ``lines``.
+        """
         indent = '  '*nIndent
+        # entries are formatted by concatenating prefix and suffix (colored
+        # and indented) computed once per section
+        cl = colors['cl'] + '\n'
+        dirSuffix = '/' + cl
+        def add_entries(prefix, names, suffix=cl):
+            lines.extend(prefix + nm + suffix for nm in sorted(names))
         if (not onlyDiff) or (self._onlyInA or self._onlyInB):
             if (not onlyDiff) or self._onlyInA:
-                if labels: stream.write(indent + f'{colors["lb"]}Only in {self._pathA}{colors["cl"]}:\n')
-                for nm in sorted(nm for nm, t in self._onlyInA if 'd' == t):
-                    stream.write(indent + f'  {colors["-d"]}{nm}/{colors["cl"]}\n')  # dir
-                for nm in sorted(nm for nm, t in self._onlyInA if 'l' == t):
-                    stream.write(indent + f'  {colors["-l"]}{nm}{colors["cl"]}\n')  # link
-                for nm in sorted(nm for nm, t in self._onlyInA if 'f' == t):
-                    stream.write(indent + f'  {colors["-f"]}{nm}{colors["cl"]}\n')   # file
+                if labels: lines.append(indent + f'{colors["lb"]}Only in {self._pathA}{colors["cl"]}:\n')
+                add_entries(indent + '  ' + colors['-d'], (nm for nm, t in self._onlyInA if 'd' == t), dirSuffix)  # dir
+                add_entries(indent + '  ' + colors['-l'], (nm for nm, t in self._onlyInA if 'l' == t))  # link
+                add_entries(indent + '  ' + colors['-f'], (nm for nm, t in self._onlyInA if 'f' == t))   # file
                 if not self._onlyInA:
-                    stream.write(indent + f'  {colors["no"]}(no exclusives for A){colors["cl"]}\n')
+                    lines.append(indent + f'  {colors["no"]}(no exclusives for A){colors["cl"]}\n')
             if (not onlyDiff) or self._onlyInB:
-                if labels: stream.write(indent + f'{colors["lb"]}Only in {self._pathB}{colors["cl"]}:\n')
-                for nm in sorted(nm for nm, t in self._onlyInB if 'd' == t):
-                    stream.write(indent + f'  {colors["+d"]}{nm}/{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in self._onlyInB if 'l' == t):
-                    stream.write(indent + f'  {colors["+l"]}{nm}{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in self._onlyInB if 'f' == t):
-                    stream.write(indent + f'  {colors["+f"]}{nm}{colors["cl"]}\n')
+                if labels: lines.append(indent + f'{colors["lb"]}Only in {self._pathB}{colors["cl"]}:\n')
+                add_entries(indent + '  ' + colors['+d'], (nm for nm, t in self._onlyInB if 'd' == t), dirSuffix)
+                add_entries(indent + '  ' + colors['+l'], (nm for nm, t in self._onlyInB if 'l' == t))
+                add_entries(indent + '  ' + colors['+f'], (nm for nm, t in self._onlyInB if 'f' == t))
                 if not self._onlyInB:
-                    stream.write(indent + f'  {colors["no"]}(no exclusives for B){colors["cl"]}\n')
+                    lines.append(indent + f'  {colors["no"]}(no exclusives for B){colors["cl"]}\n')
 
         if not self._recursive:
             # For non-recursive diff, print "for sure different" and
@@ -647,100 +845,108 @@ class DirDiff(object):
             differ = self._common - self._mayBeIdentic
             if (not onlyDiff) or differ:
                 if labels:
-                    stream.write(indent + f'{colors["lb"]}Eponymous common FS entries{colors["lb"]}:\n')
-                    stream.write(indent + '  {colors["lb"]}Different{colors["cl"]}:\n')
-                for nm in sorted(nm for nm, t in differ if 'd' == t):
-                    stream.write(f'    {colors["~d"]}{nm}/{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in differ if 'l' == t):
-                    stream.write(f'    {colors["~l"]}{nm}{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in differ if 'f' == t):
-                    stream.write(f'    {colors["~f"]}{nm}{colors["cl"]}\n')
+                    lines.append(indent + f'{colors["lb"]}Eponymous common FS entries{colors["lb"]}:\n')
+                    lines.append(indent + '  {colors["lb"]}Different{colors["cl"]}:\n')
+                add_entries('    ' + colors['~d'], (nm for nm, t in differ if 'd' == t), dirSuffix)
+                add_entries('    ' + colors['~l'], (nm for nm, t in differ if 'l' == t))
+                add_entries('    ' + colors['~f'], (nm for nm, t in differ if 'f' == t))
                 if not differ:
-                    stream.write(indent + '    {colors["no"]}(no obvious diffs){colors["cl"]}\n')
+                    lines.append(indent + '    {colors["no"]}(no obvious diffs){colors["cl"]}\n')
             if (not onlyDiff) or self._mayBeIdentic:
-                if labels: stream.write(indent + '  {colors["lb"]}May be identical{colors["cl"]}:\n')
-                for nm in sorted(nm for nm, t in self._mayBeIdentic if 'd' == t):
-                    stream.write(indent + f'    {colors["=d"]}{nm}/{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in self._mayBeIdentic if 'l' == t):
-                    stream.write(indent + f'    {colors["=l"]}{nm}{colors["cl"]}\n')
-                for nm in sorted(nm for nm, t in self._mayBeIdentic if 'f' == t):
-                    stream.write(indent + f'    {colors["=f"]}{nm}{colors["cl"]}\n')
+                if labels: lines.append(indent + '  {colors["lb"]}May be identical{colors["cl"]}:\n')
+                add_entries(indent + '    ' + colors['=d'], (nm for nm, t in self._mayBeIdentic if 'd' == t), dirSuffix)
+                add_entries(indent + '    ' + colors['=l'], (nm for nm, t in self._mayBeIdentic if 'l' == t))
+                add_entries(indent + '    ' + colors['=f'], (nm for nm, t in self._mayBeIdentic if 'f' == t))
                 if not (self._mayBeIdentic):
-                    stream.write(indent + '    {colors["no"]}(no may-be-identical){colors["cl"]}\n')
+                    lines.append(indent + '    {colors["no"]}(no may-be-identical){colors["cl"]}\n')
         else:
             identicalDirs  = self.identicDirs
             differentDirs  = self.differentDirs
             differentFiles = self.differentFiles  #set(nm for nm, t in self._common if 'f' == t) - self._identicFiles
 
             if (not onlyDiff) or differentDirs or differentFiles:
-                if labels: stream.write(indent + f'{colors["lb"]}Eponymous common FS entries:{colors["cl"]}\n')
+                if labels: lines.append(indent + f'{colors["lb"]}Eponymous common FS entries:{colors["cl"]}\n')
 
             if not onlyDiff:
-                if labels: stream.write(indent + f'  {colors["lb"]}Identical:{colors["cl"]}\n')
+                if labels: lines.append(indent + f'  {colors["lb"]}Identical:{colors["cl"]}\n')
                 # Identical dirs:
-                for nm in sorted(identicalDirs):
-                    stream.write(indent + f'    {colors["=d"]}{nm}/{colors["cl"]}\n')
+                add_entries(indent + '    ' + colors['=d'], identicalDirs, dirSuffix)
                 # Identical links:
-                for nm in sorted(self.identicLinks):
-                    stream.write(indent + f'    {colors["=l"]}{nm}{colors["cl"]}\n')
+                add_entries(indent + '    ' + colors['=l'], self.identicLinks)
                 # Identical files
-                for identicalFile in sorted(self.identicFiles):
-                    stream.write(indent + f'    {colors["=f"]}{identicalFile}{colors["cl"]}\n')
+                add_entries(indent + '    ' + colors['=f'], self.identicFiles)
                 # fallback msg
                 if (not identicalDirs) and (not self.identicFiles) and (not self.identicLinks):
-                    stream.write(indent + f'    {colors["no"]}(no identical items){colors["cl"]}\n')
+                    lines.append(indent + f'    {colors["no"]}(no identical items){colors["cl"]}\n')
 
             if (not onlyDiff) or (differentDirs or differentFiles):
-                if labels: stream.write(indent + f'  {colors["lb"]}Different:{colors["cl"]}\n')
+                if labels: lines.append(indent + f'  {colors["lb"]}Different:{colors["cl"]}\n')
                 for nm in sorted(differentDirs):
-                    stream.write(indent + f'    {colors["~d"]}{nm}/{colors["cl"]}\n')
-                    self._subDiff[nm].print_report(stream=stream, nIndent=nIndent+3, colors=colors
-                            , onlyDiff=onlyDiff, labels=labels)
-                for nm in sorted(self.differentLinks):
-                    stream.write(indent + f'    {colors["~l"]}{nm}{colors["cl"]}\n')
-                for nm in sorted(differentFiles):
-                    stream.write(indent + f'    {colors["~f"]}{nm}{colors["cl"]}\n')
+                    lines.append(indent + f'    {colors["~d"]}{nm}/{colors["cl"]}\n')
+                    self._get_subdiff(nm)._report_lines(lines, nIndent+3, onlyDiff
+                            , colors, labels)
+                add_entries(indent + '    ' + colors['~l'], self.differentLinks)
+                add_entries(indent + '    ' + colors['~f'], differentFiles)
                 if not (differentDirs or differentFiles):
-                    stream.write(indent + f'    {colors["no"]}(no different items){colors["cl"]}\n')
+                    lines.append(indent + f'    {colors["no"]}(no different items){colors["cl"]}\n')
+        return lines
 
     def _cache_to_save(self):
         """
         Aux routine returning recursive dict containing cache of identical
         files. Used in (de)serialization routines.
+
+        Only different sub-directories are saved, as diffs of identical ones
+        are never traversed.
         """
-        r = {'identicFiles': list(self._identicFiles), 'sub': {}}
-        for subDir, subDiff in self._subDiff.items():
-            r['sub'][subDir] = subDiff._cache_to_save()
+        # (sub-diffs are traversed with explicit stack rather than recursively)
+        r = {}
+        stack = [(self, r)]
+        while stack:
+            diff, node = stack.pop()
+            node['identicFiles'] = list(diff._identicFiles)
+            node['sub'] = {}
+            for subDir, subDiff in diff.nonTrivialDiffs.items():
+                node['sub'][subDir] = {}
+                stack.append((subDiff, node['sub'][subDir]))
         return r
 
-    def serializable_dict(self):
+    def serializable_dict(self, binary=False):
         """
         Produces minified set of data, suitable for saving. Returned dictionary
         can be written as JSON or it can be pickle for further restore.
+
+        If ``binary`` is set, digests are kept as bytes instead of being
+        encoded as strings (suitable for pickle, but not for JSON).
         """
-        # make deepcopy of dir structures, as we going to turn bytes into
-        # encoded strings; save original paths
-        savedObj = { 'a': copy.deepcopy(self._a), 'pathA': self._pathA
-                   , 'b': copy.deepcopy(self._b), 'pathB': self._pathB
+        def _encode(digest):
+            return digest if binary else base64.b64encode(digest).decode('ascii')
+        # aux function to convert entries properties to dicts with bytes
+        # encoded as (base64) strings
+        def _bytes_to_b64(tree):
+            items = {}
+            for relPath, props in tree['items'].items():
+                props = props._asdict()
+                if props['digest']:
+                    props['digest'] = _encode(props['digest'])
+                items[relPath] = props
+            # (lists of names are not modified, so they are not copied)
+            return {'items': items, 'children': tree['children']}
+        # convert bytes to strings; save original paths
+        savedObj = { 'a': _bytes_to_b64(self._a), 'pathA': self._pathA
+                   , 'b': _bytes_to_b64(self._b), 'pathB': self._pathB
+                   , 'relPath': self._relPath
+                   , 'formatVersion': gSerializationFormatVersion
                    }
-        # aux function to encode bytes as strings
-        def _bytes_to_hex(obj):
-            if '!ownProps' in obj.keys():
-                if 'md5sum' in obj['!ownProps'].keys() and obj['!ownProps']['md5sum']:
-                    obj['!ownProps']['md5sum'] = hashlib.md5(obj['!ownProps']['md5sum']).hexdigest()
-                if 'meta' in obj['!ownProps'].keys() and obj['!ownProps']['meta']:
-                    obj['!ownProps']['meta'] = base64.b64encode(obj['!ownProps']['meta'])
-            for k in obj.keys():
-                if k.startswith('!'): continue
-                obj[k] = _bytes_to_hex(obj[k])
-            return obj
-        # convert bytes to strings
-        savedObj['a'] = _bytes_to_hex(savedObj['a'])
-        savedObj['b'] = _bytes_to_hex(savedObj['b'])
         # if recursive, save file comparison results to avoid FS queries on
         # restoration
         if self._recursive:
             savedObj.update(self._cache_to_save())
+        # save digests cache (valid only for same hashing algorithm)
+        if self._digestCache:
+            savedObj['digestCache'] = {'algo': gHashAlgo, 'entries': list(
+                    [*k, _encode(digest)]
+                    for k, digest in self._digestCache.items())}
         return savedObj
 
     @classmethod
@@ -749,36 +955,75 @@ class DirDiff(object):
         Uses dictionary created with ``serializable_dict()`` to restore
         ``DirDiff`` object.
         """
-        # converts encoded bytes to Python bytes
-        def _hex_to_bytes(obj):
-            if '!ownProps' in obj.keys():
-                if 'md5sum' in obj['!ownProps'].keys() and obj['!ownProps']['md5sum']:
-                    obj['!ownProps']['md5sum'] = bytes.fromhex(obj['!ownProps']['md5sum'])
-                if 'meta' in obj['!ownProps'].keys() and obj['!ownProps']['meta']:
-                    obj['!ownProps']['meta'] = base64.b64decode(obj['!ownProps']['meta'])
-            for k in obj.keys():
-                if k.startswith('!'): continue
-                obj[k] = _hex_to_bytes(obj[k])
-            return obj
+        formatVersion = obj.pop('formatVersion', None)
+        if formatVersion != gSerializationFormatVersion:
+            raise RuntimeError('Directory diff was saved by incompatible'
+                    f' version of the tool (format version {formatVersion},'
+                    f' expected {gSerializationFormatVersion}); please,'
+                    ' regenerate it.')
+        # converts encoded bytes to Python bytes (digests saved with
+        # ``binary=True`` are bytes already)
+        def _decode(digest):
+            return base64.b64decode(digest) if type(digest) is str else digest
+        def _str_to_bytes(tree):
+            for relPath, props in tree['items'].items():
+                digest = props['digest']
+                tree['items'][relPath] = OwnProps(props['path'], props['size']
+                        , _decode(digest) if digest else digest
+                        , props['fsType'], props['linkTarget'])
+            return tree
         # get 
-        a = _hex_to_bytes(obj['a'])
-        obj.pop('a')
-        pathA = obj['pathA']
-        obj.pop('pathA')
+        a = _str_to_bytes(obj.pop('a'))
+        pathA = obj.pop('pathA')
+
+        b = _str_to_bytes(obj.pop('b'))
+        pathB = obj.pop('pathB')
+        relPath = obj.pop('relPath', '')
+        digestCache = obj.pop('digestCache', None)
+        kwargs = {}
+        if digestCache and digestCache['algo'] == gHashAlgo:
+            kwargs['inodeDigests'] = dict((tuple(entry[:-1]), _decode(entry[-1]))
+                    for entry in digestCache['entries'])
 
-        b = _hex_to_bytes(obj['b'])
-        obj.pop('b')
-        pathB = obj['pathB']
-        obj.pop('pathB')
+        # recursive diffs are saved with cache of identical files
+        return cls(pathA, pathB, a=a, b=b, recursive='identicFiles' in obj
+                , _savedObj=obj, _relPath=relPath, **kwargs)
 
-        if 'identicFiles' in obj.keys():
-            return cls(pathA, pathB, a=a, b=b, recursive=True, _savedObj=obj)
-        return cls(pathA, pathB, a=a, b=b, recursive=False, _savedObj=obj)
 
+def fast_copy(src, dst):
+    """
+    Copies file content and permission bits (as ``shutil.copy()`` does for
+    file destination). Where available, uses ``copy_file_range()`` so data
+    is not passed through user space (and can be reflinked by file systems
+    supporting it); falls back to ``shutil.copyfile()`` otherwise.
+    """
+    nCopied = 0
+    if hasattr(os, 'copy_file_range'):
+        with open(src, 'rb') as fSrc, open(dst, 'wb') as fDst:
+            size = os.fstat(fSrc.fileno()).st_size
+            try:
+                while nCopied < size:
+                    n = os.copy_file_range(fSrc.fileno(), fDst.fileno(), size - nCopied)
+                    if not n: break  # EOF (file truncated meanwhile)
+                    nCopied += n
+            except OSError as e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL
+                                  , errno.EOPNOTSUPP, errno.EPERM):
+                    raise
+                nCopied = 0
+    # empty files, files of unknown size (procfs, etc) and files that can
+    # not be copied in kernel are copied by regular means
+    copied = nCopied > 0
+    if not copied:
+        shutil.copyfile(src, dst)
+    shutil.copymode(src, dst)
+    return dst
 
 def create_incremental_copy( dirDiff #baseDir, subjDir
         , outDir=None, filesFilter=None
-        , dirsFilter=None, link=os.symlink, dryRun=False):
+        , dirsFilter=None, link=os.symlink, dryRun=False
+        , nThreads=None
+        , _destructive=None, _submit=None):
     """
     Creates an "incremental snapshot" directory at ``outDir`` that will contain
     all the files and/or directories from ``subjDir`` which are identical to
@@ -796,18 +1041,45 @@ def create_incremental_copy( dirDiff #baseDir, subjDir
 
     Note: ``dryRun=True`` prevents ``link`` from being called at all (so if
     ``link()`` is also behaving dry, you won't see any messages anyway).
+
+    Linking and copying is done by ``nThreads`` threads (as with
+    ``dfs_fs_items()``, ``min(32, 4*nCPUs)`` by default).
     """
     L = logging.getLogger(__name__)
+    if _submit is None:
+        # top-level call: links and copies of the whole tree are done on
+        # distinct paths, so they are submitted to the pool and errors are
+        # re-raised once all of them are finished
+        if nThreads is None: nThreads = min(32, (os.cpu_count() or 1)*4)
+        if nThreads <= 1:
+            return create_incremental_copy(dirDiff, outDir=outDir
+                    , filesFilter=filesFilter, dirsFilter=dirsFilter
+                    , link=link, dryRun=dryRun
+                    , _destructive=_destructive
+                    , _submit=lambda fn, *args, **kwargs: fn(*args, **kwargs))
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nThreads) as executor:
+            r = create_incremental_copy(dirDiff, outDir=outDir
+                    , filesFilter=filesFilter, dirsFilter=dirsFilter
+                    , link=link, dryRun=dryRun
+                    , _destructive=_destructive
+                    , _submit=lambda *args, **kwargs: futures.append(executor.submit(*args, **kwargs)))
+        for future in futures: future.result()
+        return r
     baseDir, subjDir = dirDiff.a, dirDiff.b
     if outDir is None: outDir = subjDir
-    # destructive mode means that we modify subject dir
-    destructive = os.path.realpath(outDir) == os.path.realpath(subjDir)
+    # destructive mode means that we modify subject dir; resolved once for
+    # the top-level dir and forwarded to sub-directories
+    destructive = _destructive
+    if destructive is None:
+        destructive = os.path.realpath(outDir) == os.path.realpath(subjDir)
     if dirDiff.isIdentical:
         L.info(f'Linking "{baseDir}" -> "{outDir}" as subject matches base.')
         # both directories are identical -- just create a link and that's it
         if not dryRun: link(baseDir, outDir)
         return True
-    if not os.path.isdir(outDir):
+    if not destructive:
+        # (subject dir exists for sure in destructive mode)
         os.makedirs(outDir, exist_ok=True)
     # - identic items
     #       in destructive mode we remove existing item and create links
@@ -824,12 +1096,12 @@ def create_incremental_copy( dirDiff #baseDir, subjDir
     for identicDir in dirDiff.identicDirs:
         srcDir = os.path.join(baseDir, identicDir)
         dstDir = os.path.join(outDir,  identicDir)
-        if not dryRun: link(srcDir, dstDir)
+        if not dryRun: _submit(link, srcDir, dstDir)
     for identicFile in dirDiff.identicFiles:
         srcFile = os.path.join(baseDir, identicFile)
         dstFile = os.path.join(outDir,  identicFile)
         L.info(f'Linking file "{srcFile}" -> "{dstFile}"')
-        if not dryRun: link(srcFile, dstFile)
+        if not dryRun: _submit(link, srcFile, dstFile)
     # - new items (exist only in subject dir)
     #       for destructive mode we simply do not touch items that exist only
     #       in the subject dir, while for non-destructive we copy them
@@ -839,12 +1111,12 @@ def create_incremental_copy( dirDiff #baseDir, subjDir
                 srcDir = os.path.join(subjDir, newItem)
                 dstDir = os.path.join(outDir,  newItem)
                 L.info(f'Copying dir "{srcDir}" -> "{dstDir}"')
-                if not dryRun: shutil.copytree( srcDir, dstDir )
+                if not dryRun: _submit(shutil.copytree, srcDir, dstDir, copy_function=fast_copy)
             elif 'f' == t:
                 srcFile = os.path.join(subjDir, newItem)
                 dstFile = os.path.join(outDir,  newItem)
                 L.info(f'Copying file "{srcFile}" -> "{dstFile}"')
-                if not dryRun: shutil.copy( srcFile, dstFile )
+                if not dryRun: _submit(fast_copy, srcFile, dstFile)
             else:
                 raise RuntimeError(f"Unsupported FS entry type: {t}")
     # - files changed in the new dir
@@ -855,7 +1127,7 @@ def create_incremental_copy( dirDiff #baseDir, subjDir
             srcFile = os.path.join(subjDir, changedFile)
             dstFile = os.path.join(outDir,  changedFile)
             L.info(f'Copying "{srcFile}" -> "{dstFile}"')
-            if not dryRun: shutil.copy(srcFile, dstFile)
+            if not dryRun: _submit(fast_copy, srcFile, dstFile)
     # - changed directories
     for subDir, subDirDiff in dirDiff.nonTrivialDiffs.items():
         subOutDir = None
@@ -865,6 +1137,7 @@ def create_incremental_copy( dirDiff #baseDir, subjDir
                 , outDir=subOutDir
                 , filesFilter=filesFilter, dirsFilter=dirsFilter
                 , link=link, dryRun=dryRun
+                , _destructive=destructive, _submit=_submit
                 )
 
 #
@@ -878,11 +1151,20 @@ def mk_soft_link(src, dest, relative=True, dryRun=False):
     else:
         src_ = os.path.abspath(src)
         src = src_
-    L.debug(f'Creating symbolic link "{src}" -> "{dest}"'
-            + (f', relative is "{src_}"' if relative else '')
-            + (' (dry run)' if dryRun else ''))
+    if L.isEnabledFor(logging.DEBUG):
+        L.debug(f'Creating symbolic link "{src}" -> "{dest}"'
+                + (f', relative is "{src_}"' if relative else '')
+                + (' (dry run)' if dryRun else ''))
     if not os.path.exists(src):
         raise RuntimeError(f'Soft link source path "{src}" does not exist')
+    if not dryRun:
+        # destination is checked only if link can not be created (it is
+        # usually just removed by caller)
+        try:
+            os.symlink(src_, dest)
+            return
+        except FileExistsError:
+            pass
     if os.path.exists(dest):
         raise RuntimeError(f'Soft link destination path "{dest}" exists')
     if not dryRun:
@@ -903,7 +1185,16 @@ def mk_soft_link__abs_dry(src, dest):
 
 def mk_hard_link(src, dest, exist_ok=True, dryRun=False):
     L = logging.getLogger(__name__)
-    L.debug(f'Creating hard link "{src}" <-> "{dest}"' + (' (dry run)' if dryRun else ''))
+    if L.isEnabledFor(logging.DEBUG):
+        L.debug(f'Creating hard link "{src}" <-> "{dest}"' + (' (dry run)' if dryRun else ''))
+    if not dryRun:
+        # link is tried first; source and destination are checked only if
+        # it fails (hard link can not refer to non-existing source)
+        try:
+            os.link(src, dest)
+            return
+        except (FileNotFoundError, FileExistsError):
+            pass
     if not os.path.exists(src):
         raise RuntimeError(f'Hard link source path "{src}" does not exist')
     if os.path.exists(dest):
@@ -929,9 +1220,11 @@ def mk_hard_link__dry(src, dest):
 class BasePathWildcard(object):
     def __init__(self, pattern):
         self._pat = pattern
+        # wildcard is translated into regular expression once
+        self._match = re.compile(fnmatch.translate(pattern)).match
 
     def __call__(self, paths):
-        return list(p for p in paths if fnmatch.fnmatch(p, self._pat))
+        return list(p for p in paths if self._match(p) is not None)
 
 # Example of possible conflict:
 #   - a/ and b/ are duplicating
@@ -973,84 +1266,82 @@ def deduplicate(root, dupFiles, dupDirs, sourceResolvers=None
                     , mk_soft_link__abs_dry
                     , mk_soft_link__rel
                     , mk_soft_link__rel_dry)
-    # process directories first
+    # resolved directories are memoized (duplicates usually share ancestor
+    # dirs), so only the last path component has to be checked per item
+    realdir = functools.lru_cache(maxsize=None)(os.path.realpath)
+    def realpath(relPath):
+        dirName, name = os.path.split(os.path.join(root, relPath))
+        p = os.path.join(realdir(dirName), name)
+        return os.path.realpath(p) if os.path.islink(p) else p
     itemsToDelete = {}       # files and directories to be substituted by links (path -> (src, rule name))
     itemsToKeep = {}         # files and directories to become link targets (path -> rule name)
-    for dirGroup in dupDirs:
-        origDir, resolverName = _resolve_source(dirGroup, sourceResolvers, fsItemsStr='Dirs')
-        if origDir is None or type(origDir) is not str:
+    def queue_group(group, fsType, fsItemsStr, groupStr):
+        orig, resolverName = _resolve_source(tuple(sorted(group)), sourceResolvers, fsItemsStr=fsItemsStr)
+        if orig is None or type(orig) is not str:
             raise RuntimeError('Failed to resolve single source for'
-                    + ' duplicate directories group: %s'%(
-                        ', '.join(sorted(dirGroup))))
-        origFullPath = os.path.realpath(os.path.join(root, origDir))
-        itemsToKeep[origFullPath] = (resolverName, 'd')
-        for d2rm in dirGroup:
-            if d2rm == origDir: continue
-            dfp = os.path.realpath(os.path.join(root, d2rm))
-            if dfp in itemsToDelete.keys():
-                if itemsToDelete[dfp][0] != origFullPath:
-                    raise RuntimeError(f'Conflicting paths for {dfp}:'
-                            + f' {itemsToDelete[dfp][0]} choosen by rule'
-                            + f' "{itemsToDelete[dfp][1]}" and'
-                            + f' {origFullPath} choosen by "{resolverName}"')
-            itemsToDelete[dfp] = (origFullPath, resolverName, 'd')
+                    + f' duplicate {groupStr} group: %s'%(
+                        ', '.join(sorted(group))))
+        origFullPath = realpath(orig)
+        itemsToKeep[origFullPath] = (resolverName, fsType)
+        groupItems = {realpath(item): (origFullPath, resolverName, fsType)
+                for item in group if item != orig}
+        for p in groupItems.keys() & itemsToDelete.keys():
+            if itemsToDelete[p][0] != origFullPath:
+                raise RuntimeError(f'Conflicting paths for {p}:'
+                        + f' {itemsToDelete[p][0]} choosen by rule'
+                        + f' "{itemsToDelete[p][1]}" and'
+                        + f' {origFullPath} choosen by "{resolverName}"')
+        itemsToDelete.update(groupItems)
+    # process directories first
+    for dirGroup in dupDirs:
+        queue_group(dirGroup, 'd', 'Dirs', 'directories')
     if linkFileIsSymbolic:
         # for soft links -- also process file linking
         for fileGroup in dupFiles:
-            origFile, resolverName = _resolve_source(fileGroup, sourceResolvers, fsItemsStr='')
-            if origFile is None or type(origFile) is not str:
-                raise RuntimeError('Failed to resolve single source for'
-                        + ' duplicate files group: %s'%(
-                            ', '.join(sorted(fileGroup))))
-            origFullPath = os.path.realpath(os.path.join(root, origFile))
-            itemsToKeep[origFullPath] = (resolverName, 'f')
-            for f2rm in fileGroup:
-                if f2rm == origFile: continue
-                ffp = os.path.realpath(os.path.join(root, f2rm))
-                if ffp in itemsToDelete.keys():
-                    if itemsToDelete[ffp][0] != origFullPath:
-                        raise RuntimeError(f'Conflicting paths for {ffp}:'
-                                + f' {itemsToDelete[ffp][0]} choosen by rule'
-                                + f' "{itemsToDelete[ffp][1]}" and'
-                                + f' {origFullPath} choosen by {resolverName}')
-                itemsToDelete[ffp] = (origFullPath, resolverName, 'f')
+            queue_group(fileGroup, 'f', '', 'files')
     # check that none of the "original" (source) items will be deleted
+    dirsToDelete = set(p for p, (_, _, fsType) in itemsToDelete.items() if 'd' == fsType)
     for pathToKeep, (resolverName, t) in itemsToKeep.items():
-        assert pathToKeep not in itemsToDelete.keys()  # should prohibited logically
-        # check if path to keep is sub-path of any of the path to delete
-        for c in itemsToDelete.keys():
-            if not is_subpath_of(pathToKeep, c): continue
+        assert pathToKeep not in itemsToDelete  # should prohibited logically
+        # check if path to keep is sub-path of any of the dirs to delete (only
+        # ancestors of the path are looked up)
+        c = pathToKeep
+        while c != os.path.dirname(c):
+            c = os.path.dirname(c)
+            if c not in dirsToDelete: continue
             raise RuntimeError(f'Conflict: {"directory" if t == "d" else "file"}'
                     f' "{os.path.relpath(pathToKeep, root)}" must be kept'
                     f' according to the rule "{resolverName}", but'
                     f' rule "{itemsToDelete[c][1]}" prescribes it to be deleted.'
                     )
-    # avoid repeatative deletions by removing children
-    deleteItems = set(p for p in itemsToDelete.keys())
-    hadRemovals = True
-    while hadRemovals:
-        deletedItems = None
-        hadRemovals = False
-        for cItem in sorted(deleteItems):
-            if cItem not in itemsToDelete.keys(): continue  # already un-queued
-            origFullPath, _, fsType = itemsToDelete[cItem]
-            if fsType != 'd': continue
-            deletedItems = set(p for p in deleteItems if is_subpath_of(p, cItem))
-            deletedItems.remove(cItem)
-            if not deletedItems: continue
-            L.debug( f'Deleting of {os.path.relpath(cItem, root)} will delete'
+    # avoid repeatative deletions by removing children. When paths are
+    # sorted by components, items nested in a directory immediately follow
+    # it, so they are collected in a single pass
+    nestedItems = {}
+    parentDir = None
+    for cItem in sorted(itemsToDelete.keys(), key=lambda p: p.split(os.sep)):
+        if parentDir is not None and cItem.startswith(parentDir + os.sep):
+            nestedItems[parentDir].append(cItem)
+        elif 'd' == itemsToDelete[cItem][2]:
+            parentDir = cItem
+            nestedItems[parentDir] = []
+        else:
+            parentDir = None
+    for parentDir, deletedItems in nestedItems.items():
+        if not deletedItems: continue
+        if L.isEnabledFor(logging.DEBUG):
+            L.debug( f'Deleting of {os.path.relpath(parentDir, root)} will delete'
                    + f' also {", ".join(os.path.relpath(p, root) for p in sorted(deletedItems))}')
-            hadRemovals = True
-            for deleteItem in deletedItems:
-                itemsToDelete.pop(deleteItem)
-            deleteItems -= set(deletedItems)
-            break
-    # delete and link
-    for cItem in sorted(deleteItems):
+        for deleteItem in deletedItems:
+            itemsToDelete.pop(deleteItem)
+    # delete and link (relative paths are computed only to be logged)
+    infoEnabled = L.isEnabledFor(logging.INFO)
+    for cItem in sorted(itemsToDelete.keys()):
         origFullPath, _, fsType = itemsToDelete[cItem]
         if 'd' == fsType:
-            L.info(f'Substituting directory {os.path.relpath(cItem, root)}'
-                    + f' with link to {os.path.relpath(origFullPath, root)})')
+            if infoEnabled:
+                L.info(f'Substituting directory {os.path.relpath(cItem, root)}'
+                        + f' with link to {os.path.relpath(origFullPath, root)})')
             if not dryRun:
                 shutil.rmtree(cItem)
                 link_dir(origFullPath, cItem)
@@ -1059,8 +1350,9 @@ def deduplicate(root, dupFiles, dupDirs, sourceResolvers=None
             # ^^^ TODO: this is permitted case as user still might want to have
             #     selection for hard links. In this case we should remove
             #     processed entries from file duplicates list
-            L.info(f'Substituting file {os.path.relpath(cItem, root)}'
-                    + f' with link to {os.path.relpath(origFullPath, root)})')
+            if infoEnabled:
+                L.info(f'Substituting file {os.path.relpath(cItem, root)}'
+                        + f' with link to {os.path.relpath(origFullPath, root)})')
             if not dryRun:
                 os.remove(cItem)
                 link_file(origFullPath, cItem)
@@ -1068,8 +1360,9 @@ def deduplicate(root, dupFiles, dupDirs, sourceResolvers=None
         # for hard links it does not matter which we took as original
         for fileGroup in dupFiles:
             if len(fileGroup) < 2: continue
-            L.debug('Joining files: ' + ', '.join(sorted(fileGroup)))
-            filesToLink = list(sorted(fileGroup))
+            filesToLink = sorted(fileGroup)
+            if L.isEnabledFor(logging.DEBUG):
+                L.debug('Joining files: ' + ', '.join(filesToLink))
             orig = filesToLink[0]
             filesToLink = filesToLink[1:]
             for linkTgt in filesToLink:
@@ -1106,6 +1399,24 @@ def add_argument_parser_options(p):
             , default='consider'
             , dest='handleSymlinks'
             )
+    p.add_argument('--hash', help='Hashing algorithm used to compare files and'
+            ' directories. Entries of same size and "sha256" digest are'
+            ' considered identical; "xxh3_128" is much faster, but is not'
+            ' resistant to collisions, so content of entries with matching'
+            ' digests is compared, unless --trust-hash is given (requires'
+            ' `xxhash\' module).'
+            , choices=['sha256', 'xxh3_128']
+            , default='sha256'
+            , dest='hashAlgo'
+            )
+    p.add_argument('--trust-hash', help='Consider entries of same size and'
+            ' digest identical without comparing their content, even if'
+            ' hashing algorithm is not collision-resistant. Mismatching files'
+            ' of colliding digests will be replaced with links by'
+            ' deduplication.'
+            , action='store_true'
+            , dest='trustHash'
+            )
     p.add_argument('--links-type', help='Type of the links to create.'
             ' If "hard" is specified, symbolic relative links will be used'
             ' for directories.'
@@ -1149,10 +1460,15 @@ def run( subjDir, baseDir=None, destDir=None, dryRun=False, useDiff=None
         , printReport=False, reportOnlyDiff=True
             , reportColors=None, reportNoColors=None, reportLabels=True
         , links='symbolic-relative'
+        , hashAlgo='sha256'
+        , trustHash=False
         ):
     """
     Generalized entry point procedure.
     """
+    global gHashAlgo, gTrustDigests
+    gHashAlgo = hashAlgo
+    gTrustDigests = trustHash
     filesFilter = None  # TODO
     dirsFilter = None  # TODO
     sourceResolvers = None  # TODO
@@ -1178,9 +1494,8 @@ def run( subjDir, baseDir=None, destDir=None, dryRun=False, useDiff=None
         assert type(useDiff) is str
         diffObj = None
         if useDiff.lower().endswith('.json.gz'):
-            with gzip.open(useDiff, 'r') as fJsGz:
-                bDiffStr = fJsGz.read()
-            diffObj = json.loads(bDiffStr.decode())
+            with gzip.open(useDiff, 'rt', encoding='utf-8') as fJsGz:
+                diffObj = json.load(fJsGz)
         elif useDiff.lower().endswith('.pickle'):
             with open(useDiff, 'rb') as f:
                 diffObj = pickle.load(f)
@@ -1212,16 +1527,17 @@ def run( subjDir, baseDir=None, destDir=None, dryRun=False, useDiff=None
     if dirDiff:
         # save dir-diff if need
         if outDiff:
-            diffObj = dirDiff.serializable_dict()
             if outDiff.lower().endswith('.json.gz'):
-                with gzip.open(outDiff, 'w') as fJsGz:
-                    fJsGz.write(json.dumps(diffObj).encode())
+                with gzip.open(outDiff, 'wt', encoding='utf-8') as fJsGz:
+                    json.dump(dirDiff.serializable_dict(), fJsGz)
             elif outDiff.lower().endswith('.pickle'):
+                # (pickle stores bytes as is)
                 with open(outDiff, 'wb') as f:
-                    pickle.dump(diffObj, f)
+                    pickle.dump(dirDiff.serializable_dict(binary=True), f
+                            , protocol=pickle.HIGHEST_PROTOCOL)
             else:
                 with open(outDiff, 'w') as fJs:
-                    json.dump(diffObj, fJs, sort_keys=True, indent=2)
+                    json.dump(dirDiff.serializable_dict(), fJs, sort_keys=True, indent=2)
         # print report if need
         if printReport:
             assert not (reportColors and reportNoColors)
@@ -1260,8 +1576,8 @@ def run( subjDir, baseDir=None, destDir=None, dryRun=False, useDiff=None
         if printReport:
             if type(printReport) is str:
                 if printReport.lower().endswith('.json.gz'):
-                    with gzip.open(printReport, 'w') as fJsGz:
-                        fJsGz.write(json.dumps(duplicates).encode())
+                    with gzip.open(printReport, 'wt', encoding='utf-8') as fJsGz:
+                        json.dump(duplicates, fJsGz)
                 elif printReport.lower().endswith('.json'):
                     with open(printReport, 'w') as fJs:
                         json.dump(duplicates, fJs, sort_keys=True, indent=2)
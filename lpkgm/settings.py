@@ -1,4 +1,4 @@
-import os, logging, json, glob, re
+import os, logging, glob, re, copy, string
 import lpkgm.protection
 
 #
@@ -24,6 +24,27 @@ gSettings = {
     'installer-extensions'  : ['lpkgm.default_installer']
 }
 
+# Parsed JSON files, indexed by (path, modification time, size)
+_gJsonFilesCache = {}
+
+def _load_json_cached(path):
+    """
+    Returns content of JSON file, parsing it only if file was not loaded yet
+    or was modified since then. Returned object is a copy, so caller is free
+    to modify it.
+    """
+    from lpkgm.utils import load_json_file  # import here to avoid circular import
+    st = os.stat(path)
+    k = (path, st.st_mtime_ns, st.st_size)
+    data = _gJsonFilesCache.get(k, None)
+    if data is None:
+        data = _gJsonFilesCache[k] = load_json_file(path)
+    return copy.deepcopy(data)
+
+# Compiled regular expressions of package descriptions, indexed by
+# expression string
+_gCompiledRxs = {}
+
 def _packages_from_descriptions(descriptions, settingsDir):
     L = logging.getLogger(__name__)
     for item in descriptions:
@@ -33,18 +54,17 @@ def _packages_from_descriptions(descriptions, settingsDir):
             # loaded object, use filename without extension as package name
             if not os.path.isfile(item):
                 raise RuntimeError(f'Not a file: {item}')
-            with open(item, 'r') as f:
-                pkgData = json.load(f)
+            pkgData = _load_json_cached(item)
             if 'name' not in pkgData:
                 pkgData['name'] = os.path.splitext(os.path.basename(item))[0]
             L.debug(f'Loaded JSON package data from {item}')
             item = pkgData
         if type(item) is dict:
             # assumed a standalone package -- get the "name" from object
-            # and use the rest as package definition
+            # and use the rest as package definition (given object is not
+            # modified)
             pkgName = item['name']
-            item.pop('name')
-            yield pkgName, item, settingsDir
+            yield pkgName, {k: v for k, v in item.items() if k != 'name'}, settingsDir
         elif type(item) in (list, tuple) and 2 == len(item):
             # otherwise, assume a complex case, used for large software
             # bundles repo: a file lookup wildcard with regular expression
@@ -52,7 +72,10 @@ def _packages_from_descriptions(descriptions, settingsDir):
             pathWildcard = os.path.expandvars(pathWildcard.format(**gSettings['definitions']))
             L.debug('Getting package descriptions from glob'
                     + f' pattern {pathWildcard} matching regular expression "{rx}"')
-            rx = re.compile(rx)
+            rxStr = rx
+            rx = _gCompiledRxs.get(rxStr, None)
+            if rx is None:
+                rx = _gCompiledRxs[rxStr] = re.compile(rxStr)
             nPkgs = 0
             for pkgDefFilePath in glob.glob(pathWildcard):
                 m = rx.match(pkgDefFilePath)
@@ -63,19 +86,18 @@ def _packages_from_descriptions(descriptions, settingsDir):
                 # definitions
                 pathSemantics = dict(m.groupdict())
                 # load package data
-                with open(pkgDefFilePath) as f:
-                    pkgDef = json.load(f)
+                pkgDef = _load_json_cached(pkgDefFilePath)
                 pkgName = None
-                if 'name' in pkgDef.keys():
+                if 'name' in pkgDef:
                     # "name" given in .json has priority over regular
                     # expression tokens
                     pkgName = pkgDef['name']
-                    pkgDef.pop('name')
+                    pkgDef = {k: v for k, v in pkgDef.items() if k != 'name'}
                 elif 'name' in pathSemantics.keys():
                     # otherwise -- try to get package name from "name" rx
                     # matching group
                     pkgName = pathSemantics['name']
-                    pathSemantics.pop('name')
+                    del pathSemantics['name']
                 else:
                     # otherwise, consider filename without extension as package
                     # name
@@ -92,6 +114,45 @@ def _packages_from_descriptions(descriptions, settingsDir):
             raise RuntimeError(f'Unable to interpret "packages" entry "{item}"'
                     + ' as package(s) definition.')
 
+def _expand_definitions(definitions):
+    """
+    Substitutes references to other definitions (in ``str.format()`` syntax)
+    within values of ``definitions`` dict, in place. Values are formatted in
+    order of their dependencies, so every value is formatted at most once.
+    """
+    formatter = string.Formatter()
+    expanded = {}
+    # values with no braces have neither references nor escapes, and are
+    # taken as is
+    for k, v in definitions.items():
+        if '{' not in v and '}' not in v:
+            expanded[k] = v
+    for k in definitions.keys():
+        # resolve dependencies of the value depth-first, with explicit stack
+        # of (key, keys it refers to) pairs
+        stack = []
+        if k not in expanded:
+            stack.append((k, None))
+        while stack:
+            key, deps = stack[-1]
+            if deps is None:
+                # (leading identifier of field names like "a.b" or "a[0]")
+                deps = list(re.match(r'\w*', fieldName).group()
+                        for _, fieldName, _, _ in formatter.parse(definitions[key])
+                        if fieldName)
+                stack[-1] = (key, deps)
+            pending = [d for d in deps if d in definitions and d not in expanded]
+            if pending:
+                if pending[0] in (item[0] for item in stack):
+                    raise RuntimeError('Circular reference in definitions: '
+                            + ' -> '.join(item[0] for item in stack)
+                            + f' -> {pending[0]}')
+                stack.append((pending[0], None))
+                continue
+            expanded[key] = definitions[key].format(**expanded)
+            stack.pop()
+    definitions.update(expanded)
+
 def read_settings_file(settingsFilePath, definitions=None):
     """
     Reads settings file (.json).
@@ -100,36 +161,28 @@ def read_settings_file(settingsFilePath, definitions=None):
     some point. This is NOT a pure function as it changes ``gSettings``
     object.
     """
+    from lpkgm.utils import load_json_file  # import here to avoid circular import
     L = logging.getLogger(__name__)
     # initialize definitions to empty list, if not given
     if not definitions: definitions=[]
     # load file
     if not os.path.isfile(settingsFilePath):
         raise RuntimeError(f"Not a file: \"{settingsFilePath}\"")
-    with open(settingsFilePath) as f:
-        settings = json.load(f)
+    settings = load_json_file(settingsFilePath)
     if 'definitions' not in settings.keys():
         settings['definitions'] = {}
     # append some common definitions
     if 'pwd' not in settings['definitions'].keys():
         settings['definitions']['pwd'] = os.getcwd()
-    # expand variables in definitions until there is no more to expand; note
-    # that it directly affects gSettings
-    # (todo: detect infinite loop?)
+    # expand variables in definitions; note that it directly affects
+    # gSettings
     if definitions:
         for entry in definitions:
             k, v = entry.split('=')
             gSettings['definitions'][k] = v
     for k, v in settings['definitions'].items():
         gSettings['definitions'][k] = os.path.expandvars(v)
-    while True:
-        hadChange = False
-        for k, v in gSettings['definitions'].items():
-            newVal = v.format(**gSettings['definitions'])
-            if newVal != v:
-                adChange = True
-            gSettings['definitions'][k] = newVal
-        if not hadChange: break
+    _expand_definitions(gSettings['definitions'])
     # modify gSettings, substituting 1st level entries
     for k, v in settings.items():
         if k in ('packages', 'definitions'): continue  # omit some keys
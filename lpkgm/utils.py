@@ -1,23 +1,54 @@
-import os, requests, logging, json, subprocess, glob
-from fnmatch import fnmatch
+import os, re, requests, logging, json, subprocess, fcntl, contextlib \
+     , concurrent.futures, functools, gzip, tempfile, errno
+from fnmatch import fnmatchcase, translate
 from tqdm import tqdm
+try:
+    import orjson  # optional, for faster JSON parsing
+except ImportError:
+    orjson = None
 
 from lpkgm.settings import gSettings
 
+def pkg_ver_str(pkgVer):
+    """Returns version string for version given as string or as dict."""
+    return pkgVer['fullVersion'] if type(pkgVer) is dict else pkgVer
+
 def pkg_manifest_file_path(pkgName, pkgVer):
     # NOTE: shell-style wildcard will result in a wildcard
     # path (that's an anticipated case)
-    pkgVerStr = pkgVer
-    if type(pkgVer) is dict:
-        pkgVerStr = pkgVer['fullVersion']
+    return _pkg_manifest_file_path(pkgName, pkg_ver_str(pkgVer))
+
+def _pkg_manifest_file_path(pkgName, pkgVerStr):
     return os.path.join(gSettings['packages-registry-dir'], pkgName, pkgVerStr + '.json')
 
+def is_wildcard(s):
+    """Returns whether string contains shell-style wildcard characters."""
+    return any(c in s for c in '*?[')
+
 def pkg_manifest_file_path_to_name_and_ver(path):
     assert path.endswith('.json')
     pkgVer  = os.path.basename(path)[:-5]  # get filename and strip off .json suffix
     pkgName = os.path.basename(os.path.dirname(path))
     return pkgName, pkgVer
 
+def load_json_file(path):
+    """
+    Returns parsed content of JSON file. Uses ``orjson`` module if it is
+    available, falling back to standard ``json`` for documents ``orjson``
+    does not accept (e.g. with ``NaN`` or very large integers). Files with
+    ``.gz`` suffix are decompressed.
+    """
+    open_ = gzip.open if path.endswith('.gz') else open
+    if orjson is None:
+        with open_(path, 'rt') as f:
+            return json.load(f)
+    with open_(path, 'rb') as f:
+        content = f.read()
+    try:
+        return orjson.loads(content)
+    except orjson.JSONDecodeError:
+        return json.loads(content)
+
 def get_package_manifests(pkgName, pkgVer_, exclude=None):
     """
     Loads package manifests according to given package name and version.
@@ -27,28 +58,29 @@ def get_package_manifests(pkgName, pkgVer_, exclude=None):
     and version) to omit from loading. Items within the ``exclude`` will
     be applied at once (logic and).
     """
-    if exclude is None: exclude = []
-    exclude_ = []
-    for excludeItem in exclude:
-        exclude_.append(pkg_manifest_file_path(*excludeItem))
-    pkgVerStr = pkgVer_
-    if type(pkgVer_) is dict:
-        pkgVerStr = pkgVer_['fullVersion']
+    # exclusion wildcards are joined into single regular expression
+    excludeMatch = None
+    if exclude:
+        excludeMatch = re.compile('|'.join(translate(pkg_manifest_file_path(*excludeItem))
+                for excludeItem in exclude)).match
+    pkgVerStr = pkg_ver_str(pkgVer_)
     assert type(pkgVerStr) is str
-    # pkgName and pkgVerStr can be a shell-style wildcard, resulting
-    # in a wildcard path
-    manifestFilePathPat = pkg_manifest_file_path(pkgName, pkgVerStr)
-    r = []
-    for manifestFilePath in glob.glob(manifestFilePathPat):
-        skip = False
-        for excludeItem in exclude_:
-            if fnmatch(manifestFilePath, excludeItem):
-                skip = True
-                break
-        if skip: continue  # excluded
-        with open(manifestFilePath) as f:
-            r.append(json.load(f))
-    return r
+    # pkgName and pkgVerStr can be a shell-style wildcard, to be matched
+    # against registry entries
+    if is_wildcard(pkgName) or is_wildcard(pkgVerStr):
+        manifestFilePaths = registry_manifest_paths(pkgName, pkgVerStr)
+    else:
+        # exact name and version -- no need to scan the directory
+        manifestFilePath = _pkg_manifest_file_path(pkgName, pkgVerStr)
+        manifestFilePaths = [manifestFilePath] if os.path.isfile(manifestFilePath) else []
+    toLoad = list(manifestFilePath for manifestFilePath in manifestFilePaths
+            if excludeMatch is None or excludeMatch(manifestFilePath) is None)
+    if len(toLoad) < 2:
+        return list(load_json_file(manifestFilePath) for manifestFilePath in toLoad)
+    # multiple manifests are read concurrently (registry may reside on
+    # network FS, where reading is latency-bound)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(toLoad))) as executor:
+        return list(executor.map(load_json_file, toLoad))
 
 def sizeof_fmt(num, suffix="B"):
     """
@@ -64,10 +96,14 @@ def stats_summary(stats):
     """Shortcut for package stats summary (size and numbers of entries)"""
     return f'{sizeof_fmt(stats["size"])} in {stats["nFiles"]} files'
 
+@functools.lru_cache(maxsize=128)
 def get_gitlab_project_token(projectID, server=None):
     """
     If ``CI_JOB_TOKEN`` is not specified, tries to obtain it from the file by
     the location specified in settings.
+
+    Result is memoized per project and server for process lifetime (failures
+    are not cached).
     """
     assert projectID
     assert type(projectID) is str
@@ -97,7 +133,9 @@ def download_file_http(fileURL, outFPath):
         response.raise_for_status()
         raise RuntimeError(f"Request to {fileURL} returned status code {response.status_code}")
     totalSize = int(response.headers.get("Content-Length", 0))
-    blockSize = 1024
+    # large blocks keep per-chunk overhead (allocation, progress bar update)
+    # negligible compared to network I/O
+    blockSize = 1024*1024
     received = 0
     with tqdm(total=totalSize, unit="B"
             , unit_scale=True, ascii='.#'
@@ -111,37 +149,122 @@ def download_file_http(fileURL, outFPath):
         raise RuntimeError(f'Failed to download {fileURL} into {outFPath}: only'
                 + f' {received} bytes received out of {totalSize}')
 
-def execute_command(cmd, cwd=None, env=os.environ, joinStreams=False):
+# Max length of command output printed on error
+gErrorOutputTailLength = 64*1024
+
+# Size of command output kept in memory before being spooled to disk
+gOutputSpoolSize = 1024*1024
+
+def _output_tail(f):
+    """
+    Decodes last ``gErrorOutputTailLength`` bytes of command output
+    spooled to file ``f``.
+    """
+    size = f.seek(0, os.SEEK_END)
+    if size <= gErrorOutputTailLength:
+        f.seek(0)
+        return f.read().decode(errors='replace')
+    f.seek(-gErrorOutputTailLength, os.SEEK_END)
+    return f'(... {size - gErrorOutputTailLength} bytes omitted ...)\n' \
+        + f.read().decode(errors='replace')
+
+def execute_command(cmd, cwd=None, env=None, joinStreams=False, captureOutput=False):
     """
     Common thin wrapper on shell command execution for more verbose logging
-    and error handling.
+    and error handling. If ``env`` is not given, command inherits current
+    environment.
+
+    Output of the command is spooled to temporary files, so memory use is
+    bounded for commands producing huge output (like build logs). Returned
+    stdout and stderr are bytes only if ``captureOutput`` is set, and
+    ``None`` otherwise.
     """
     L = logging.getLogger(__name__)
-    cmdString = '$ ' + ' '.join(cmd)
-    if cwd:
-        cmdString = cwd + ' ' + cmdString
-    L.info(cmdString)
+    if L.isEnabledFor(logging.INFO):
+        cmdString = '$ ' + ' '.join(cmd)
+        if cwd:
+            cmdString = cwd + ' ' + cmdString
+        L.info(cmdString)
     #
-    p = subprocess.Popen( cmd
-            , shell=False
-            , stdout=subprocess.PIPE, stderr=(subprocess.PIPE if not joinStreams else subprocess.STDOUT)
-            , env=env
-            , cwd=cwd
-            )
-    outs, errs = p.communicate()
-    if 0 != p.returncode:
-        L.error('Error occured during shell execution.')
-        if not joinStreams:
-            L.error(f'stderr output of the command (exit code {p.returncode}):')
-            L.error(errs.decode())
-        else:
-            L.error(f'combined stdout and stderr output of the command (exit code {p.returncode}):')
-            L.error(outs.decode())
-        raise RuntimeError(f'Shell command failed with code {p.returncode}.')
+    with contextlib.ExitStack() as stack:
+        fOut = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=gOutputSpoolSize))
+        fErr = stack.enter_context(tempfile.SpooledTemporaryFile(max_size=gOutputSpoolSize)) \
+                if not joinStreams else None
+        returncode = subprocess.call( cmd
+                , shell=False
+                , stdout=fOut, stderr=(fErr if not joinStreams else subprocess.STDOUT)
+                , env=env
+                , cwd=cwd
+                )
+        if 0 != returncode:
+            L.error('Error occured during shell execution.')
+            # only the tail of (possibly huge) output is decoded and printed
+            if not joinStreams:
+                L.error(f'stderr output of the command (exit code {returncode}):')
+                L.error(_output_tail(fErr))
+            else:
+                L.error(f'combined stdout and stderr output of the command (exit code {returncode}):')
+                L.error(_output_tail(fOut))
+            raise RuntimeError(f'Shell command failed with code {returncode}.')
+        outs, errs = None, None
+        if captureOutput:
+            fOut.seek(0)
+            outs = fOut.read()
+            if fErr is not None:
+                fErr.seek(0)
+                errs = fErr.read()
     # forward stderr output, if any
     #if errs:
     #    L.warning(errs.decode())
-    return outs, errs, p.returncode
+    return outs, errs, returncode
+
+def _glob_name_match(name, pattern):
+    """Matches file name against wildcard the way ``glob`` does."""
+    if name.startswith('.') and not pattern.startswith('.'):
+        return False  # hidden entries are matched only explicitly
+    return fnmatchcase(name, pattern)
+
+def registry_manifest_paths(pkgNamePattern='*', pkgVerPattern='*'):
+    """
+    Generator function yielding paths of manifest files in registry matching
+    given package name and version wildcards. Same as globbing
+    ``<registry>/<name>/<version>.json``, but directories are listed lazily,
+    without building list of all matches.
+
+    Literal (non-wildcard) name and version are looked up directly, without
+    listing the directories.
+    """
+    verFilePattern = pkgVerPattern + '.json'
+    if not is_wildcard(pkgNamePattern):
+        pkgDirPaths = [os.path.join(gSettings['packages-registry-dir'], pkgNamePattern)]
+    else:
+        pkgDirPaths = _registry_pkg_dirs(pkgNamePattern)
+    for pkgDirPath in pkgDirPaths:
+        if not is_wildcard(verFilePattern):
+            manifestPath = os.path.join(pkgDirPath, verFilePattern)
+            if os.path.exists(manifestPath):
+                yield manifestPath
+            continue
+        try:
+            pkgDirIt = os.scandir(pkgDirPath)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        with pkgDirIt:
+            for entry in pkgDirIt:
+                if _glob_name_match(entry.name, verFilePattern):
+                    yield entry.path
+
+def _registry_pkg_dirs(pkgNamePattern):
+    """Yields paths of package directories in registry matching wildcard."""
+    try:
+        registryIt = os.scandir(gSettings['packages-registry-dir'])
+    except FileNotFoundError:
+        return
+    with registryIt:
+        for pkgDirEntry in registryIt:
+            if not _glob_name_match(pkgDirEntry.name, pkgNamePattern): continue
+            if not pkgDirEntry.is_dir(): continue
+            yield pkgDirEntry.path
 
 def packages(pkgNamePattern=None, pkgVerPattern=None):
     """
@@ -150,9 +273,8 @@ def packages(pkgNamePattern=None, pkgVerPattern=None):
     L = logging.getLogger(__name__)
     if not pkgNamePattern: pkgNamePattern = '*'
     if not pkgVerPattern:  pkgVerPattern  = '*'
-    for pkgFilePath in glob.glob(gSettings['packages-registry-dir'] + f'/{pkgNamePattern}/{pkgVerPattern}.json'):
-        with open(pkgFilePath, 'r') as pkgFile:
-            pkgData = json.load(pkgFile)
+    for pkgFilePath in registry_manifest_paths(pkgNamePattern, pkgVerPattern):
+        pkgData = load_json_file(pkgFilePath)
         if not ('package' in pkgData and 'version' in pkgData):
             L.warning(f'Warning: file "{pkgFilePath}" does not'
                     + ' seem to be a package file (ignored).')
@@ -160,3 +282,43 @@ def packages(pkgNamePattern=None, pkgVerPattern=None):
         # TODO: fnmatch(.lower())
         #if pkgName and pkgName.lower() not in pkgData['package'].lower(): continue
         yield pkgData, pkgFilePath
+
+@contextlib.contextmanager
+def registry_lock(exclusive=True):
+    """
+    Advisory (``flock()``-based) lock on the packages registry preventing
+    concurrent lpkgm invocations from corrupting manifests and dependency graph
+    cache. Read-only operations shall acquire shared lock, while modifying
+    ones -- an exclusive lock.
+
+    Registry directory is created, if need, for exclusive lock (so first
+    installations are serialized as well). If lock file can not be created
+    because registry is on read-only FS (like CVMFS client), or shared lock
+    is requested on not yet existing registry, proceeds without locking.
+    """
+    L = logging.getLogger(__name__)
+    registryDir = gSettings['packages-registry-dir']
+    lockFilePath = os.path.join(registryDir, '.lpkgm.lock')
+    try:
+        if exclusive:
+            os.makedirs(registryDir, exist_ok=True)
+        lockFD = os.open(lockFilePath, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        readOnly = e.errno in (errno.EROFS, errno.EACCES)
+        # (nothing to be read yet)
+        noRegistry = not exclusive and not os.path.exists(registryDir)
+        if not (readOnly or noRegistry): raise
+        L.warning(f'Unable to open registry lock file {lockFilePath} ({str(e)}),'
+                ' proceeding without lock.')
+        yield None
+        return
+    try:
+        try:
+            fcntl.flock(lockFD, (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH) | fcntl.LOCK_NB)
+        except BlockingIOError:
+            L.info(f'Registry is locked by another lpkgm process, waiting for {lockFilePath}...')
+            fcntl.flock(lockFD, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield lockFD
+    finally:
+        fcntl.flock(lockFD, fcntl.LOCK_UN)
+        os.close(lockFD)
@@ -1,4 +1,4 @@
-import unittest
+import unittest, copy
 import lpkgm.dependencies
 from lpkgm.protection import ProtectionRule, protecting_rules_report
 
@@ -14,13 +14,13 @@ class MockProtectionRuleVersionCheck(ProtectionRule):
         self._version = version
         super().__init__(label)
 
-    def __call__(self, version, time):
+    def __call__(self, version):
         return version == self._version
 
 class TestDepPair(unittest.TestCase):
     # Simple case of two packages, foo depends from bar
     def setUp(self):
-        self.depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=f'/tmp/xxx.{__name__}.gpickle')
+        self.depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=':memory:')
         self.depGraph.add( ('foo', '1.0.0'), ('bar', '1.0.0') )  # "foo" depends on "bar"
 
     def test_basic_dependencies_pair(self):
@@ -49,32 +49,32 @@ class TestDepTriplet(unittest.TestCase):
     #   1. if C is protected, A and B are also protected (protection propagated)
     #   2. if only A/B is protected, C and B/A are not protected (protection isolated)
     #   3. if A and B are protected, C is not
+    @classmethod
+    def setUpClass(cls):
+        # graph is built once, every test gets its own copy
+        cls._depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=':memory:')
+        cls._depGraph.add( ('C', '1'), ('A', '1') )  # C depends on A
+        cls._depGraph.add( ('C', '1'), ('B', '1') )  # C depends on B
+
     def setUp(self):
-        self.depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=f'/tmp/xxx.{__name__}.gpickle')
-        self.depGraph.add( ('C', '1'), ('A', '1') )  # C depends on A
-        self.assertEqual( self.depGraph.depends_on('C', '1'), [('A', '1')] )
+        self.depGraph = copy.deepcopy(self._depGraph)
+        self.assertEqual( self.depGraph.depends_on('C', '1'), [('A', '1'), ('B', '1')] )
         self.assertEqual( self.depGraph.dependency_of('A', '1'), [('C', '1')] )
-        self.depGraph.add( ('C', '1'), ('B', '1') )  # C depends on B
-        self.installedTimesCache = { ('A', '1'): 123
-                                   , ('B', '1'): 123
-                                   , ('C', '1'): 123 }  # mock
 
     def test_dependency_propagation(self):
         protectC = {'C': [MockProtectionRule()]}
         # test plain and recursive cases of 1st for C:
         for isRecursive in (False, True):
-            cRules = self.depGraph.get_protecting_rules('C', '1', 0
+            cRules = self.depGraph.get_protecting_rules('C', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertTrue(cRules)  # make sure it casts to True
             self.assertEqual(cRules, ('C', '1', ['mock'], []))
         # test that A got protection from C
-        aRules = self.depGraph.get_protecting_rules('A', '1', 0
+        aRules = self.depGraph.get_protecting_rules('A', '1'
                     , protectionRules=protectC
                     , recursive=True
-                    , installedTimesCache=self.installedTimesCache
                     )
         #print('==>', aRules)  # XXX
         self.assertTrue(aRules)  # make sure it casts to True
@@ -82,7 +82,7 @@ class TestDepTriplet(unittest.TestCase):
         report = '\n' + protecting_rules_report(aRules[3])  # just test that it won't fail
         #print(report)
         # test that A is not protected logically when recursion is disabled
-        aRules = self.depGraph.get_protecting_rules('A', '1', 0
+        aRules = self.depGraph.get_protecting_rules('A', '1'
                     , protectionRules=protectC, recursive=False)
         self.assertFalse(aRules)
 
@@ -90,23 +90,20 @@ class TestDepTriplet(unittest.TestCase):
         protectC = {'A': [MockProtectionRule()]}
         # test plain and recursive cases of 1st for C:
         for isRecursive in (False, True):
-            cRules = self.depGraph.get_protecting_rules('C', '1', 0
+            cRules = self.depGraph.get_protecting_rules('C', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertFalse(cRules)
-            bRules = self.depGraph.get_protecting_rules('B', '1', 0
+            bRules = self.depGraph.get_protecting_rules('B', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertFalse(bRules)
             # test that A got protected by itself
-            aRules = self.depGraph.get_protecting_rules('A', '1', 0
+            aRules = self.depGraph.get_protecting_rules('A', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertTrue(aRules)  # make sure it casts to True
             self.assertEqual(aRules, ('A', '1', ['mock'], []))
@@ -115,25 +112,22 @@ class TestDepTriplet(unittest.TestCase):
         protectC = {'A': [MockProtectionRule('mock-a')], 'B': [MockProtectionRule('mock-b')]}
         # test plain and recursive cases of 1st for C:
         for isRecursive in (False, True):
-            cRules = self.depGraph.get_protecting_rules('C', '1', 0
+            cRules = self.depGraph.get_protecting_rules('C', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertFalse(cRules)
             # test that A and B got protected by themselves
-            aRules = self.depGraph.get_protecting_rules('A', '1', 0
+            aRules = self.depGraph.get_protecting_rules('A', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertTrue(aRules)  # make sure it casts to True
             self.assertEqual(aRules, ('A', '1', ['mock-a'], []))
 
-            bRules = self.depGraph.get_protecting_rules('B', '1', 0
+            bRules = self.depGraph.get_protecting_rules('B', '1'
                     , protectionRules=protectC
                     , recursive=isRecursive
-                    , installedTimesCache=self.installedTimesCache
                     )
             self.assertTrue(bRules)
             self.assertEqual(bRules, ('B', '1', ['mock-b'], []))
@@ -150,19 +144,22 @@ class TestGenericCase(unittest.TestCase):
     #
     #  (a, 3) <-
     #  (d, 1) <-`- (c, 2)
-    def setUp(self):
-        self.depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=f'/tmp/xxx.{__name__}.gpickle')
-        # add first sub-graph
-        self.depGraph.add( ('b', '1'), ('a', '1') )  # b/1 depends on a/1
-        self.depGraph.add( ('b', '2'), ('a', '1') )  # b/2 depends on a/1
-        # add second sub-graph
-        self.depGraph.add( ('b', '3'), ('a', '2') )  # b/3 depends on a/2
-        self.depGraph.add( ('c', '1'), ('b', '3') )  # c/1 depends on a/2
-        # add third sub-graph
-        self.depGraph.add( ('c', '2'), ('a', '3') )  # c/2 depends on a/3
-        self.depGraph.add( ('c', '2'), ('d', '1') )  # ... and on d/1
-        # mock installaed times
-        self.installedTimesCache = dict((k, 123) for k in self.depGraph.g.nodes)
+    @classmethod
+    def setUpClass(cls):
+        # graph is built once, every test gets its own copy
+        depGraph = lpkgm.dependencies.PkgGraph(forceRebuild=False, filePath=':memory:')
+        depGraph.add_many([
+            # first sub-graph
+            (('b', '1'), ('a', '1')),  # b/1 depends on a/1
+            (('b', '2'), ('a', '1')),  # b/2 depends on a/1
+            # second sub-graph
+            (('b', '3'), ('a', '2')),  # b/3 depends on a/2
+            (('c', '1'), ('b', '3')),  # c/1 depends on a/2
+            # third sub-graph
+            (('c', '2'), ('a', '3')),  # c/2 depends on a/3
+            (('c', '2'), ('d', '1')),  # ... and on d/1
+            ])
+        cls._depGraph = depGraph
         # testing assets:
         # - all possible edges
         # not needed? testing weakly connected components in nx itself seems redundant
@@ -178,7 +175,12 @@ class TestGenericCase(unittest.TestCase):
         #    (('c', '2'), ('d', '1')),
         #}
 
+    def setUp(self):
+        self.depGraph = copy.deepcopy(self._depGraph)
+
     def _mock_removal(self, unprotected):
+        # (set is used for membership tests, whatever iterable is given)
+        unprotected = frozenset(unprotected)
         # with those rules -- test removal sorting
         rmTiers = self.depGraph.sort_for_removal(unprotected)
         removedItems = set()
@@ -187,7 +189,7 @@ class TestGenericCase(unittest.TestCase):
                 # test, dependency is not broken:
                 # - none of dependencies are removed (yet)
                 deps = self.depGraph.dependency_of(*item)
-                self.assertFalse(set(deps) & removedItems)
+                self.assertTrue(removedItems.isdisjoint(deps))
                 # - provided packages are removed or not scheduled for removal
                 provided = self.depGraph.depends_on(*item)
                 for providedOne in provided:
@@ -196,7 +198,7 @@ class TestGenericCase(unittest.TestCase):
                 # "remove"
                 removedItems.add(item)
         # make sure all removed
-        self.assertEqual(removedItems, set(unprotected))
+        self.assertEqual(removedItems, unprotected)
 
     def test_components_isolation(self):
         # test that we can actually see sub-graphs ("components" in nx
@@ -229,6 +231,34 @@ class TestGenericCase(unittest.TestCase):
             else:
                 assert False  # must not be reached
 
+    def test_removal_tiers_within_removed(self):
+        # a/2 and c/1 are related via b/3 only, which is kept, so they are
+        # removed independently
+        rmTiers = self.depGraph.sort_for_removal([('a', '2'), ('c', '1'), ('b', '1'), ('a', '1')])
+        self.assertEqual(sorted(rmTiers), [[('a', '1'), ('b', '1')], [('a', '2')], [('c', '1')]])
+        # trivial cases
+        self.assertEqual(self.depGraph.sort_for_removal([('d', '1')]), [[('d', '1')]])
+        self.assertEqual(self.depGraph.sort_for_removal([]), [])
+
+    def test_removal_tiers_missing(self):
+        with self.assertRaises(RuntimeError):
+            self.depGraph.sort_for_removal([('a', '1'), ('x', '1')])
+
+    def test_removal_order(self):
+        # dependency relations are respected within the given set only
+        self.assertEqual(self.depGraph._removal_order({('c', '1'), ('b', '3'), ('a', '2')})
+                , [('a', '2'), ('b', '3'), ('c', '1')])
+        # packages of same generation are sorted
+        self.assertEqual(self.depGraph._removal_order({('c', '2'), ('d', '1'), ('a', '3')})
+                , [('a', '3'), ('d', '1'), ('c', '2')])
+        self.assertEqual(self.depGraph._removal_order({('b', '2'), ('b', '1'), ('a', '1')})
+                , [('a', '1'), ('b', '1'), ('b', '2')])
+
+    def test_removal_order_circular(self):
+        self.depGraph.add(('a', '2'), ('c', '1'))  # a/2 -> c/1 -> b/3 -> a/2
+        with self.assertRaises(RuntimeError):
+            self.depGraph._removal_order({('c', '1'), ('b', '3'), ('a', '2')})
+
     def test_garbage_collection_1(self):
         # case with a-1, a-3, b-3 being protected
         protectionRules = {
@@ -238,15 +268,13 @@ class TestGenericCase(unittest.TestCase):
                 'b': [MockProtectionRuleVersionCheck('3', 'mock-b-3')],
             }
         # test 1st level protection
-        directlyProtected = self.depGraph.get_protected_rules_by_pkg(
-                protectionRules, self.installedTimesCache)
+        directlyProtected = self.depGraph.get_protected_rules_by_pkg(protectionRules)
         self.assertEqual(directlyProtected, {('a', '1'): ['mock-a-1']
             , ('a', '3'): ['mock-a-3']
             , ('b', '3'): ['mock-b-3']
             })
         # test all protected pkgs
-        allProtected = self.depGraph.get_protected_pkgs(
-                protectionRules, self.installedTimesCache)
+        allProtected = self.depGraph.get_protected_pkgs(protectionRules)
         self.assertEqual(allProtected, set([('a', '1'), ('a', '3'), ('b', '3'), ('a', '2')]))
         # test all not protected
         checkScheduledForRemoval = set([('b', '1'), ('b', '2')
@@ -254,8 +282,7 @@ class TestGenericCase(unittest.TestCase):
             , ('d', '1')
             , ('c', '2')
             ])
-        unprotected = self.depGraph.get_unprotected_pkgs(
-                protectionRules, self.installedTimesCache)
+        unprotected = self.depGraph.get_unprotected_pkgs(protectionRules)
         self.assertEqual(unprotected, checkScheduledForRemoval)
         self._mock_removal(unprotected)
 
@@ -268,23 +295,20 @@ class TestGenericCase(unittest.TestCase):
                 'b': [MockProtectionRuleVersionCheck('1', 'mock-b-1')],
             }
         # test 1st level protection
-        directlyProtected = self.depGraph.get_protected_rules_by_pkg(
-                protectionRules, self.installedTimesCache)
+        directlyProtected = self.depGraph.get_protected_rules_by_pkg(protectionRules)
         self.assertEqual(directlyProtected, {('c', '1'): ['mock-c-1']
             , ('c', '2'): ['mock-c-2']
             , ('b', '1'): ['mock-b-1']
             })
         # test all protected pkgs
-        allProtected = self.depGraph.get_protected_pkgs(
-                protectionRules, self.installedTimesCache)
+        allProtected = self.depGraph.get_protected_pkgs(protectionRules)
         self.assertEqual(allProtected, set([('a', '1'), ('b', '1')
             , ('a', '2'), ('b', '3'), ('c', '1')
             , ('a', '3'), ('d', '1'), ('c', '2')
             ]))
         # test all not protected
         checkScheduledForRemoval = set([('b', '2')])
-        unprotected = self.depGraph.get_unprotected_pkgs(
-                protectionRules, self.installedTimesCache)
+        unprotected = self.depGraph.get_unprotected_pkgs(protectionRules)
         self.assertEqual(unprotected, checkScheduledForRemoval)
         self._mock_removal(unprotected)
 
@@ -292,17 +316,14 @@ class TestGenericCase(unittest.TestCase):
         # case with b-1, c-1, c-2 being protected
         protectionRules = {}  # no protection rules
         # test 1st level protection
-        directlyProtected = self.depGraph.get_protected_rules_by_pkg(
-                protectionRules, self.installedTimesCache)
+        directlyProtected = self.depGraph.get_protected_rules_by_pkg(protectionRules)
         self.assertFalse(directlyProtected)
         # test all protected pkgs
-        allProtected = self.depGraph.get_protected_pkgs(
-                protectionRules, self.installedTimesCache)
+        allProtected = self.depGraph.get_protected_pkgs(protectionRules)
         self.assertFalse(allProtected)
         # test all not protected
         checkScheduledForRemoval = set(self.depGraph.g.nodes)
-        unprotected = self.depGraph.get_unprotected_pkgs(
-                protectionRules, self.installedTimesCache)
+        unprotected = self.depGraph.get_unprotected_pkgs(protectionRules)
         self.assertEqual(unprotected, checkScheduledForRemoval)
         self._mock_removal(unprotected)
 
@@ -317,20 +338,17 @@ class TestGenericCase(unittest.TestCase):
                      ],
             }
         # test 1st level protection
-        directlyProtected = self.depGraph.get_protected_rules_by_pkg(
-                protectionRules, self.installedTimesCache)
+        directlyProtected = self.depGraph.get_protected_rules_by_pkg(protectionRules)
         self.assertEqual(directlyProtected, {('c', '1'): ['mock-c-1']
             , ('c', '2'): ['mock-c-2']
             , ('b', '1'): ['mock-b-1']
             , ('b', '2'): ['mock-b-2']
             })
         # test all protected pkgs
-        allProtected = self.depGraph.get_protected_pkgs(
-                protectionRules, self.installedTimesCache)
+        allProtected = self.depGraph.get_protected_pkgs(protectionRules)
         self.assertEqual(allProtected, set(self.depGraph.g.nodes))
         # test all not protected
-        unprotected = self.depGraph.get_unprotected_pkgs(
-                protectionRules, self.installedTimesCache)
+        unprotected = self.depGraph.get_unprotected_pkgs(protectionRules)
         self.assertFalse(unprotected)
         self._mock_removal(unprotected)
 
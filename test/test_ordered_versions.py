@@ -38,4 +38,20 @@ class TestOrderedVersions(unittest.TestCase):
                 l = list(versions)
                 self.assertEqual(len(l), 1)
                 self.assertEqual(l[0][1][1], 123)
+
+    def test_top_k_with_tied_versions(self):
+        # 1.2 is installed twice (different commits not taken into account by
+        # the order), so two most recent versions are 1.2 and 1.1
+        order = lpkgm.ordered_versions.VersionsOrder(attributesOrder=['major', 'minor']
+                , ortogonalBy=[])
+        versions = [ ({'major': 1, 'minor': 2, 'commit': 'a'}, 1)
+                   , ({'major': 1, 'minor': 2, 'commit': 'b'}, 2)
+                   , ({'major': 1, 'minor': 1}, 3)
+                   , ({'major': 1, 'minor': 0}, 4)
+                   ]
+        ls_ = list(order(versions, topK=2))
+        self.assertEqual(1, len(ls_))
+        _, ls = ls_[0]
+        self.assertEqual(list(k for k, _ in ls), [(1, 1), (1, 2), (1, 2)])
+        self.assertEqual(set(t for _, (_, t) in ls), {1, 2, 3})
             
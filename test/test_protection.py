@@ -0,0 +1,24 @@
+import unittest
+import lpkgm.protection
+
+def _mock_manifest(fullVersion, minor, installedAt):
+    return ( { 'package': 'foo'
+             , 'version': {'fullVersion': fullVersion, 'major': 1, 'minor': minor}
+             , 'installedAt': installedAt
+             }
+           , f'/tmp/foo/{fullVersion}.json' )
+
+class TestKeepLatest(unittest.TestCase):
+    def test_tied_versions_do_not_take_limit(self):
+        # 1.2-a and 1.2-b are the same version with respect to the order, so
+        # two latest versions are 1.2 (both) and 1.1
+        rule = lpkgm.protection.KeepLatestProtectionRule('foo'
+                , attrsOrder=['major', 'minor']
+                , latestLimit=2
+                , preloaded=[ _mock_manifest('1.2-a', 2, '2024-01-04T00:00:00')
+                            , _mock_manifest('1.2-b', 2, '2024-01-03T00:00:00')
+                            , _mock_manifest('1.1',   1, '2024-01-02T00:00:00')
+                            , _mock_manifest('1.0',   0, '2024-01-01T00:00:00')
+                            ])
+        protected = set(v for v in ('1.2-a', '1.2-b', '1.1', '1.0') if rule(v))
+        self.assertEqual(protected, {'1.2-a', '1.2-b', '1.1'})
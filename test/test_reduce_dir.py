@@ -0,0 +1,172 @@
+import unittest, os, tempfile, hashlib, io, json, pickle
+import lpkgm.reduce_dir
+
+class _ConstantHash(object):
+    """Mock hash object giving same digest for any content."""
+    def update(self, data): pass
+    def digest(self): return b'\0'*16
+
+def _mk(root, relPath, content):
+    path = os.path.join(root, relPath)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+class TestDigestVerification(unittest.TestCase):
+    # Files and directories of same sizes, but of different content, having
+    # same (colliding) digests:
+    #
+    #   a/same.f, b/same.f -- identical
+    #   a/diff.f, b/diff.f -- differ
+    #   c/, d/             -- identical dirs
+    #   e/                 -- differs from c/, d/ (same size)
+    def setUp(self):
+        self._tmpDir = tempfile.TemporaryDirectory()
+        self.root = self._tmpDir.name
+        _mk(self.root, 'a/same.f', b'same')
+        _mk(self.root, 'b/same.f', b'same')
+        _mk(self.root, 'a/diff.f', b'diff-a')
+        _mk(self.root, 'b/diff.f', b'diff-b')
+        _mk(self.root, 'c/one.f', b'1')
+        _mk(self.root, 'd/one.f', b'1')
+        _mk(self.root, 'e/one.f', b'2')
+        self._origNewHash = lpkgm.reduce_dir.new_hash
+        self._origHashAlgo = lpkgm.reduce_dir.gHashAlgo
+        lpkgm.reduce_dir.new_hash = _ConstantHash
+        lpkgm.reduce_dir.gHashAlgo = 'mock'
+
+    def tearDown(self):
+        lpkgm.reduce_dir.new_hash = self._origNewHash
+        lpkgm.reduce_dir.gHashAlgo = self._origHashAlgo
+        self._tmpDir.cleanup()
+
+    def _duplicates(self):
+        files, dirs = lpkgm.reduce_dir.find_duplicates_in(self.root, reduceDirs=True)
+        files = set(frozenset(os.path.relpath(p, self.root) for p in group) for group in files)
+        dirs = set(frozenset(group) for group in dirs)
+        return files, dirs
+
+    def test_untrusted_digests_verified(self):
+        self.assertFalse(lpkgm.reduce_dir.digests_trusted())
+        files, dirs = self._duplicates()
+        self.assertEqual(dirs, {frozenset(('c', 'd'))})
+        self.assertIn(frozenset(('a/same.f', 'b/same.f')), files)
+        self.assertFalse(any('a/diff.f' in group for group in files))
+        self.assertFalse(any('e/one.f' in group for group in files))
+
+    def test_trusted_digests_not_verified(self):
+        lpkgm.reduce_dir.gTrustDigests = True
+        try:
+            self.assertTrue(lpkgm.reduce_dir.digests_trusted())
+            _, dirs = self._duplicates()
+        finally:
+            lpkgm.reduce_dir.gTrustDigests = False
+        # colliding digests are taken as is, so a/ and b/ match
+        self.assertIn(frozenset(('a', 'b')), dirs)
+
+    def test_dir_diff_verified(self):
+        diff = lpkgm.reduce_dir.DirDiff(os.path.join(self.root, 'a')
+                , os.path.join(self.root, 'b'))
+        self.assertEqual(diff.identicFiles, {'same.f'})
+        self.assertEqual(diff.differentFiles, {'diff.f'})
+
+class TestHashSelection(unittest.TestCase):
+    def setUp(self):
+        self._origHashAlgo = lpkgm.reduce_dir.gHashAlgo
+
+    def tearDown(self):
+        lpkgm.reduce_dir.gHashAlgo = self._origHashAlgo
+
+    def test_sha256(self):
+        lpkgm.reduce_dir.gHashAlgo = 'sha256'
+        self.assertTrue(lpkgm.reduce_dir.digests_trusted())
+        h = lpkgm.reduce_dir.new_hash()
+        h.update(b'content')
+        self.assertEqual(h.digest(), hashlib.sha256(b'content').digest())
+
+    def test_xxh3(self):
+        lpkgm.reduce_dir.gHashAlgo = 'xxh3_128'
+        self.assertFalse(lpkgm.reduce_dir.digests_trusted())
+        if lpkgm.reduce_dir.xxhash is None:
+            self.assertRaises(RuntimeError, lpkgm.reduce_dir.new_hash)
+        else:
+            self.assertEqual(len(lpkgm.reduce_dir.new_hash().digest()), 16)
+
+class TestTreesIdentical(unittest.TestCase):
+    def test_trees(self):
+        with tempfile.TemporaryDirectory() as root:
+            for d in ('x', 'y', 'z'):
+                _mk(root, f'{d}/sub/f', b'content')
+                os.symlink('sub/f', os.path.join(root, d, 'ln'))
+            _mk(root, 'z/sub/g', b'extra')
+            self.assertTrue(lpkgm.reduce_dir.trees_identical(
+                os.path.join(root, 'x'), os.path.join(root, 'y')))
+            self.assertFalse(lpkgm.reduce_dir.trees_identical(
+                os.path.join(root, 'x'), os.path.join(root, 'z')))
+
+class TestDeduplicate(unittest.TestCase):
+    def test_nested_deletions_pruned(self):
+        # b/ duplicates a/, so deletion of b/sub/ and b/sub/f is done by
+        # deletion of b/; b-x/ is not nested in b/ (though follows it in
+        # plain string order)
+        with tempfile.TemporaryDirectory() as root:
+            for d in ('a', 'b'):
+                _mk(root, f'{d}/g', b'g')
+                _mk(root, f'{d}/sub/f', b'f')
+            _mk(root, 'x/g', b'x')
+            _mk(root, 'b-x/g', b'x')
+            lpkgm.reduce_dir.deduplicate(root
+                    , [{'a/g', 'b/g'}, {'a/sub/f', 'b/sub/f'}, {'x/g', 'b-x/g'}]
+                    , [{'a', 'b'}, {'a/sub', 'b/sub'}]
+                    , sourceResolvers=[('not-b', lambda items: [i for i in items if not i.startswith('b')])]
+                    , link_dir=lpkgm.reduce_dir.mk_soft_link__rel
+                    , link_file=lpkgm.reduce_dir.mk_soft_link__rel
+                    )
+            self.assertEqual(os.readlink(os.path.join(root, 'b')), 'a')
+            self.assertTrue(os.path.islink(os.path.join(root, 'b-x/g')))
+            self.assertFalse(os.path.islink(os.path.join(root, 'a/sub/f')))
+            with open(os.path.join(root, 'b/sub/f'), 'rb') as f:
+                self.assertEqual(f.read(), b'f')
+
+class TestDirDiffSerialization(unittest.TestCase):
+    def setUp(self):
+        self._tmpDir = tempfile.TemporaryDirectory()
+        self.root = self._tmpDir.name
+        _mk(self.root, 'a/same.f', b'same')
+        _mk(self.root, 'b/same.f', b'same')
+        _mk(self.root, 'a/diff.f', b'diff-a')
+        _mk(self.root, 'b/diff.f', b'diff-bb')
+        _mk(self.root, 'a/sub/one.f', b'1')
+        _mk(self.root, 'b/sub/two.f', b'2')
+        self.diff = lpkgm.reduce_dir.DirDiff(os.path.join(self.root, 'a')
+                , os.path.join(self.root, 'b'))
+
+    def tearDown(self):
+        self._tmpDir.cleanup()
+
+    def _report(self, diff):
+        stream = io.StringIO()
+        diff.print_report(stream)
+        return stream.getvalue()
+
+    def _assert_restored(self, obj):
+        restored = lpkgm.reduce_dir.DirDiff.from_dict(obj)
+        self.assertEqual(restored.a, self.diff.a)
+        self.assertEqual(restored.b, self.diff.b)
+        self.assertEqual(restored.identicFiles, {'same.f'})
+        self.assertEqual(self._report(restored), self._report(self.diff))
+
+    def test_json(self):
+        self._assert_restored(json.loads(json.dumps(self.diff.serializable_dict())))
+
+    def test_pickle(self):
+        self._assert_restored(pickle.loads(pickle.dumps(self.diff.serializable_dict(binary=True))))
+
+    def test_incompatible_version(self):
+        for formatVersion in (None, 1):
+            obj = json.loads(json.dumps(self.diff.serializable_dict()))
+            if formatVersion is None:
+                del obj['formatVersion']
+            else:
+                obj['formatVersion'] = formatVersion
+            self.assertRaises(RuntimeError, lpkgm.reduce_dir.DirDiff.from_dict, obj)
@@ -0,0 +1,37 @@
+import unittest
+from lpkgm.settings import _expand_definitions
+
+class TestExpandDefinitions(unittest.TestCase):
+    def test_references(self):
+        # "c" refers to "b" defined after it, "b" refers to "a"
+        defs = { 'c': '{b}/c'
+               , 'b': '{a}/b'
+               , 'a': '/a'
+               , 'escaped': '{{a}}-{a}'
+               , 'attr': '{a.__class__.__name__}'
+               }
+        _expand_definitions(defs)
+        self.assertEqual(defs, { 'c': '/a/b/c'
+                               , 'b': '/a/b'
+                               , 'a': '/a'
+                               , 'escaped': '{a}-/a'
+                               , 'attr': 'str'
+                               })
+
+    def test_plain_values(self):
+        # values without braces are taken as is
+        defs = {'a': 'plain', 'b': '%s $a not-a-ref'}
+        _expand_definitions(defs)
+        self.assertEqual(defs, {'a': 'plain', 'b': '%s $a not-a-ref'})
+
+    def test_circular_reference(self):
+        for defs in ( {'a': '{b}', 'b': '{a}'}
+                    , {'a': '{a}'}
+                    , {'x': '{a}', 'a': '{b}', 'b': '{c}', 'c': '{a}'}
+                    ):
+            with self.assertRaises(RuntimeError):
+                _expand_definitions(defs)
+
+    def test_undefined_reference(self):
+        with self.assertRaises(KeyError):
+            _expand_definitions({'a': '{b}/a'})
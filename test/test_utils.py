@@ -0,0 +1,97 @@
+import unittest, os, tempfile
+from lpkgm.settings import gSettings
+from lpkgm.utils import registry_manifest_paths, execute_command, registry_lock
+
+class TestRegistryManifestPaths(unittest.TestCase):
+    # Registry layout:
+    #
+    #   foo/1.0.json, foo/1.1.json, foo/2.0.json, foo/.hidden.json
+    #   bar/1.0.json, bar/notes.txt
+    #   .tmp/1.0.json
+    #   file.json  (not a package directory)
+    def setUp(self):
+        self._tmpDir = tempfile.TemporaryDirectory()
+        self.root = self._tmpDir.name
+        for relPath in ( 'foo/1.0.json', 'foo/1.1.json', 'foo/2.0.json', 'foo/.hidden.json'
+                       , 'bar/1.0.json', 'bar/notes.txt'
+                       , '.tmp/1.0.json'
+                       , 'file.json' ):
+            path = os.path.join(self.root, relPath)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        self._origRegistryDir = gSettings.get('packages-registry-dir')
+        gSettings['packages-registry-dir'] = self.root
+
+    def tearDown(self):
+        gSettings['packages-registry-dir'] = self._origRegistryDir
+        self._tmpDir.cleanup()
+
+    def _paths(self, *args):
+        return set(os.path.relpath(p, self.root) for p in registry_manifest_paths(*args))
+
+    def test_literal(self):
+        self.assertEqual(self._paths('foo', '1.1'), {'foo/1.1.json'})
+        self.assertEqual(self._paths('foo', '3.0'), set())
+        self.assertEqual(self._paths('baz', '1.0'), set())
+        self.assertEqual(self._paths('baz'), set())
+
+    def test_wildcards(self):
+        self.assertEqual(self._paths('foo'), {'foo/1.0.json', 'foo/1.1.json', 'foo/2.0.json'})
+        self.assertEqual(self._paths('foo', '1.*'), {'foo/1.0.json', 'foo/1.1.json'})
+        self.assertEqual(self._paths('*', '1.0'), {'foo/1.0.json', 'bar/1.0.json'})
+        self.assertEqual(self._paths('b?r'), {'bar/1.0.json'})
+
+    def test_hidden(self):
+        # hidden entries match only patterns starting with dot
+        self.assertEqual(self._paths('.*'), {'.tmp/1.0.json'})
+        self.assertEqual(self._paths('foo', '.*'), {'foo/.hidden.json'})
+
+    def test_no_registry(self):
+        gSettings['packages-registry-dir'] = os.path.join(self.root, 'none')
+        self.assertEqual(self._paths(), set())
+
+class TestExecuteCommand(unittest.TestCase):
+    cmd = ['sh', '-c', 'echo out; echo err >&2']
+
+    def test_captured_output(self):
+        self.assertEqual(execute_command(self.cmd, captureOutput=True), (b'out\n', b'err\n', 0))
+        self.assertEqual(execute_command(self.cmd, joinStreams=True, captureOutput=True)
+                , (b'out\nerr\n', None, 0))
+
+    def test_discarded_output(self):
+        self.assertEqual(execute_command(self.cmd), (None, None, 0))
+
+    def test_failure(self):
+        with self.assertLogs('lpkgm.utils', level='ERROR') as cm:
+            with self.assertRaises(RuntimeError):
+                execute_command(['sh', '-c', 'echo failure-reason >&2; exit 3'])
+        self.assertTrue(any('failure-reason' in line for line in cm.output))
+
+class TestRegistryLock(unittest.TestCase):
+    def setUp(self):
+        self._tmpDir = tempfile.TemporaryDirectory()
+        self.registryDir = os.path.join(self._tmpDir.name, 'registry')
+        self._origRegistryDir = gSettings.get('packages-registry-dir')
+        gSettings['packages-registry-dir'] = self.registryDir
+
+    def tearDown(self):
+        gSettings['packages-registry-dir'] = self._origRegistryDir
+        self._tmpDir.cleanup()
+
+    def test_exclusive_creates_registry(self):
+        with registry_lock(exclusive=True) as lockFD:
+            self.assertIsNotNone(lockFD)
+        self.assertTrue(os.path.isfile(os.path.join(self.registryDir, '.lpkgm.lock')))
+
+    def test_shared_without_registry(self):
+        with self.assertLogs('lpkgm.utils', level='WARNING'):
+            with registry_lock(exclusive=False) as lockFD:
+                self.assertIsNone(lockFD)
+        self.assertFalse(os.path.exists(self.registryDir))
+
+    def test_unusable_registry(self):
+        open(self.registryDir, 'w').close()  # not a directory
+        for exclusive in (True, False):
+            with self.assertRaises(OSError):
+                with registry_lock(exclusive=exclusive):
+                    pass